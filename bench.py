@@ -0,0 +1,326 @@
+########################################################################################################################
+#    File: bench.py
+# Purpose: Reproducible benchmarks for db_maria.py and the App loaders, with baseline comparison.
+#  Author: Dan Huckson, https://github.com/unodan
+#
+#   Usage: python bench.py --rows 20000 --output bench.json [--baseline old.json --threshold 0.1]
+#          python bench.py --startup [--startup-budget 100]
+########################################################################################################################
+import os
+import sys
+import json
+import time
+import random
+import string
+import tempfile
+import argparse
+import platform
+import subprocess
+
+from pathlib import Path
+
+from db_maria import MariaDB
+
+version = '0.1'
+
+_place_table = 'bench_places'
+_place_sql = 'id INT UNSIGNED NOT NULL AUTO_INCREMENT, ' \
+             'zone_id INT UNSIGNED NOT NULL, ' \
+             'code VARCHAR(3) NOT NULL, ' \
+             'name VARCHAR(256) NOT NULL, ' \
+             'flags VARCHAR(9), ' \
+             'coordinates VARCHAR(16), ' \
+             'PRIMARY KEY (id), ' \
+             'INDEX (zone_id)'
+
+# Modules that only specific commands need, none of them may be loaded just by importing main and creating a MariaDB.
+_lazy_modules = ('pymysql', 'bs4', 'chardet', 'numpy', 'zipfile', 'urllib.request', 'csv', 'ingest', 'sync', 'fetch',
+                 'db_backup', 'db_metrics')
+_startup_budget = 100
+_startup_code = 'import sys, time\n' \
+                'start = time.perf_counter()\n' \
+                'import main\n' \
+                'main.MariaDB()\n' \
+                'print(time.perf_counter() - start)\n' \
+                'print(",".join(sys.modules))\n'
+
+
+def random_code(rng, size):
+    return ''.join(rng.choice(string.ascii_uppercase) for _ in range(size))
+
+
+def random_coordinates(rng):
+    return f'{rng.randint(0, 89):02d}{rng.randint(0, 59):02d}{rng.choice("NS")} ' \
+           f'{rng.randint(0, 179):03d}{rng.randint(0, 59):02d}{rng.choice("EW")}'
+
+
+def generate_csv(path, rows, seed=1):
+    rng = random.Random(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    countries = []
+    codes = set()
+    while len(countries) < 100:
+        code2 = random_code(rng, 2)
+        if code2 not in codes:
+            codes.add(code2)
+            countries.append((f'Country {code2}', code2, code2 + random_code(rng, 1)))
+
+    with open(path.joinpath('country.csv'), 'w') as f:
+        for country in countries:
+            print(','.join(country), file=f)
+
+    zones = []
+    with open(path.joinpath('2019-2 SubdivisionCodes.csv'), 'w') as f:
+        for _, code2, _ in countries:
+            for i in range(10):
+                zone = (code2, f'{i:02d}', f'Zone {code2}-{i}', 'province')
+                zones.append(zone)
+                print(','.join(f'"{v}"' for v in zone), file=f)
+
+    files = 3
+    for part in range(files):
+        with open(path.joinpath(f'bench UNLOCODE CodeListPart{part + 1}.csv'), 'w', encoding='iso-8859-1') as f:
+            for i in range(part, rows, files):
+                code2, zone, _, _ = zones[i % len(zones)]
+                row = ('', code2, f'{i % 17576:03d}'[-3:], f'Place {i}', f'Place {i}', zone,
+                       '--3-----', 'AI', '1901', '', random_coordinates(rng), '')
+                print(','.join(f'"{v}"' for v in row), file=f)
+
+    return path
+
+
+def place_rows(rows, seed=2):
+    rng = random.Random(seed)
+    for i in range(rows):
+        yield rng.randint(1, 1000), random_code(rng, 3), f'Place {i}', '--3-----', random_coordinates(rng)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def latency(function, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+    return {
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 4),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 4),
+    }
+
+
+def reset_table(db):
+    db.execute(f'DROP TABLE IF EXISTS {_place_table};')
+    db.invalidate_schema(_place_table)
+    db.create_table(_place_table, _place_sql)
+
+
+class Bench:
+    def __init__(self, db, rows):
+        self.db = db
+        self.rows = rows
+        self.results = {}
+
+    def add(self, name, value, unit, higher_is_better=True, **extra):
+        self.results[name] = dict(value=round(value, 4), unit=unit, higher_is_better=higher_is_better, **extra)
+        print(f'{name:40} {value:14.2f} {unit}')
+
+    def insert_row(self):
+        reset_table(self.db)
+        rows = min(self.rows, 5000)
+        with self.db.batch(commit_every=1000):
+            _, seconds = timed(lambda: [self.db.insert_row(_place_table, row) for row in place_rows(rows)])
+        self.add('insert_row', rows / seconds, 'rows/s')
+
+    def insert_rows(self):
+        reset_table(self.db)
+        with self.db.batch(commit_every=20):
+            _, seconds = timed(self.db.insert_rows, _place_table, place_rows(self.rows))
+        self.add('insert_rows', self.rows / seconds, 'rows/s')
+
+    def lookups(self):
+        ids = [(_place_table, random.randint(1, self.rows)) for _ in range(1000)]
+        stats = latency(self.db.row_exist, ids)
+        self.add('row_exist', stats['mean_ms'], 'ms', higher_is_better=False, **stats)
+
+        stats = latency(self.db.table_exist, [(_place_table,)] * 500)
+        self.add('table_exist', stats['mean_ms'], 'ms', higher_is_better=False, **stats)
+
+    def fetch(self):
+        sql = f'SELECT * FROM {_place_table};'
+
+        def fetchall():
+            self.db.execute(sql)
+            return len(self.db.fetchall())
+
+        count, seconds = timed(fetchall)
+        self.add('fetchall', count / seconds, 'rows/s')
+
+        count, seconds = timed(lambda: sum(1 for _ in self.db.iter_query(sql)))
+        self.add('iter_query', count / seconds, 'rows/s')
+
+    def metadata(self):
+        stats = latency(self.db.get_columns_metadata, [(_place_table,)] * 200)
+        self.add('get_columns_metadata', stats['mean_ms'], 'ms', higher_is_better=False, **stats)
+
+        self.db.invalidate_schema(_place_table)
+        stats = latency(self.db.get_table_schema, [(_place_table,)] * 200)
+        self.add('get_table_schema_cached', stats['mean_ms'], 'ms', higher_is_better=False, **stats)
+
+    def loaders(self, path):
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            # main resolves its data directory from the working directory at import time.
+            import main
+
+            app = main.App()
+            app.db = self.db
+            app.info = self.db.get_connection_info()
+            self.db.execute('DROP TABLE IF EXISTS country_places, country_zones, country;')
+            self.db.invalidate_schema()
+            for table, sql in main.App.tables():
+                self.db.create_table(table, sql)
+
+            for name, loader, table in (('update_country', app.update_country, 'country'),
+                                        ('update_country_zones', app.update_country_zones, 'country_zones'),
+                                        ('update_country_places', app.update_country_places, 'country_places')):
+                with self.db.batch(commit_every=20):
+                    _, seconds = timed(loader)
+                self.db.execute(f'SELECT COUNT(*) FROM {table};')
+                count = self.db.fetchone()[0]
+                self.add(name, count / seconds, 'rows/s', rows=count)
+        finally:
+            os.chdir(cwd)
+
+    def run(self, path):
+        self.insert_row()
+        self.insert_rows()
+        self.lookups()
+        self.fetch()
+        self.metadata()
+        self.loaders(path)
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get('results', {}).get(name)
+        if not old or not old['value']:
+            continue
+
+        change = (result['value'] - old['value']) / old['value']
+        if not result['higher_is_better']:
+            change = -change
+        result['baseline'] = old['value']
+        result['change'] = round(change, 4)
+        if change < -threshold:
+            regressions.append(name)
+            print(f'REGRESSION {name}: {old["value"]} -> {result["value"]} {result["unit"]} ({change:+.1%})')
+
+    return regressions
+
+
+def measure_startup(runs):
+    path = Path(__file__).resolve().parent
+    samples = []
+    loaded = set()
+    for _ in range(runs):
+        # A fresh interpreter each run, with bytecode writing off so every run sees the same cached .pyc state.
+        output = subprocess.run([sys.executable, '-B', '-c', _startup_code], cwd=path, capture_output=True,
+                                text=True, check=True).stdout.splitlines()
+        samples.append(float(output[-2]))
+        loaded.update(name for name in output[-1].split(',') if name in _lazy_modules)
+    return percentile(samples, 0.5) * 1000, loaded
+
+
+def startup(runs, budget):
+    median, loaded = measure_startup(runs)
+    print(f"{'startup (import main + MariaDB())':40} {median:14.2f} ms (budget {budget} ms, {runs} runs)")
+    for name in sorted(loaded):
+        print(f'STARTUP {name} is imported eagerly')
+    if median > budget:
+        print(f'STARTUP {median:.2f} ms exceeds the {budget} ms budget')
+    return 1 if loaded or median > budget else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark db_maria.py and the country loaders.')
+    parser.add_argument('--host', default=os.environ.get('MARIADB_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MARIADB_PORT', 3306)))
+    parser.add_argument('--user', default=os.environ.get('MARIADB_USER', 'mary'))
+    parser.add_argument('--password', default=os.environ.get('MARIADB_PASSWORD', 'password'))
+    parser.add_argument('--database', default='bench_countries')
+    parser.add_argument('--replica', action='append', default=[], metavar='HOST:PORT',
+                        help='route reads to this replica (repeatable), e.g. a second local server instance')
+    parser.add_argument('--policy', default='round_robin', choices=('round_robin', 'least_latency'))
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown before failing (0.10 = 10%%)')
+    parser.add_argument('--startup', action='store_true', help='only check import and start-up time, no server needed')
+    parser.add_argument('--startup-runs', type=int, default=10)
+    parser.add_argument('--startup-budget', type=float, default=_startup_budget,
+                        help='median start-up time allowed in ms')
+    args = parser.parse_args()
+
+    if args.startup:
+        return startup(args.startup_runs, args.startup_budget)
+
+    random.seed(args.seed)
+    db = MariaDB(log_file=os.devnull)
+    info = {'host': args.host, 'port': args.port, 'user': args.user, 'password': args.password}
+    replicas = [dict(info, host=replica.rsplit(':', 1)[0], port=int(replica.rsplit(':', 1)[1]))
+                for replica in args.replica]
+    if not db.connect(args.database, connection=info, replicas=replicas, policy=args.policy):
+        print(f'Could not connect to {args.host}:{args.port} as {args.user}', file=sys.stderr)
+        return 2
+
+    with tempfile.TemporaryDirectory() as path:
+        generate_csv(path, args.rows, args.seed)
+        results = Bench(db, args.rows).run(path)
+    if replicas:
+        print(json.dumps(db.get_replica_stats(), indent=2))
+
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'rows': args.rows,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report['meta']['baseline'] = args.baseline
+        report['meta']['threshold'] = args.threshold
+        report['regressions'] = regressions
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
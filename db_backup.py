@@ -0,0 +1,277 @@
+########################################################################################################################
+#    File: db_backup.py
+# Purpose: Parallel, streaming backup and restore for the MariaDB class (replaces the mysqldump popen).
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import gzip
+import json
+import time
+import hashlib
+import logging as lg
+
+from queue import Queue, Empty
+from pathlib import Path
+from threading import Thread, Lock
+
+from db_maria import MariaDB
+
+version = '0.1'
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Backup:
+    def __init__(self, db, **kwargs):
+        self.info = db.get_connection_info()
+        self.workers = kwargs.get('workers', 4)
+        self.chunk_rows = kwargs.get('chunk_rows', 100000)
+        self.batch_rows = kwargs.get('batch_rows', 1000)
+        self.compresslevel = kwargs.get('compresslevel', 6)
+        self.progress = kwargs.get('progress')
+
+        self.lock = Lock()
+        self.errors = []
+
+    def open(self, database, count):
+        connections = []
+        for _ in range(count):
+            db = MariaDB()
+            if not db.connect(database, connection=self.info):
+                break
+            connections.append(db)
+
+        if len(connections) < count:
+            for db in connections:
+                db.connection_close()
+            raise ConnectionError(f'backup:Could not open {count} connections to {database}')
+        return connections
+
+    def report(self, table, rows, size):
+        if self.progress:
+            with self.lock:
+                self.progress(table, rows, size)
+
+    def run_workers(self, connections, tasks, target):
+        queue = Queue()
+        for task in tasks:
+            queue.put(task)
+
+        def work(db):
+            while True:
+                try:
+                    task = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    target(db, task)
+                except Exception as err:
+                    with self.lock:
+                        self.errors.append(f'{task}:{str(err)}')
+                    lg.error(f'backup:{task}:{str(err)}')
+
+        threads = [Thread(target=work, args=(db,)) for db in connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def dump(self, database, path=None):
+        start = time.time()
+        path = Path(path or f"{database}_{time.strftime('%Y-%m-%d_%H%M%S')}")
+        path.mkdir(parents=True, exist_ok=True)
+        self.errors = []
+
+        coordinator = self.open(database, 1)[0]
+        connections = []
+        results = {}
+
+        def dump_table(db, table):
+            files = []
+            rows = 0
+            part = None
+
+            def open_part():
+                name = f'{table}.{len(files):05d}.sql.gz'
+                files.append({'file': name, 'rows': 0})
+                return gzip.open(path.joinpath(name), 'wt', encoding='utf-8', compresslevel=self.compresslevel)
+
+            def write_statement(f, batch):
+                f.write(f"INSERT INTO `{table}` VALUES {','.join(batch)};\n")
+
+            try:
+                for chunk in db.iter_query(f'SELECT * FROM `{table}`;', chunk_size=self.batch_rows):
+                    if part is None or files[-1]['rows'] >= self.chunk_rows:
+                        if part:
+                            part.close()
+                        part = open_part()
+
+                    placeholder = f"({('%s,' * len(chunk[0])).rstrip(',')})"
+                    statements = [db.cursor.mogrify(placeholder, row) for row in chunk]
+                    write_statement(part, statements)
+                    files[-1]['rows'] += len(chunk)
+                    rows += len(chunk)
+                    self.report(table, rows, 0)
+            finally:
+                if part:
+                    part.close()
+
+            # The count runs inside the same snapshot, so it must match what was streamed.
+            db.execute(f'SELECT COUNT(*) FROM `{table}`;')
+            expected = db.fetchone()[0]
+            if rows != expected:
+                raise RuntimeError(f'Dumped {rows} rows but the table has {expected}')
+
+            size = 0
+            for file in files:
+                file['bytes'] = path.joinpath(file['file']).stat().st_size
+                file['sha256'] = file_digest(path.joinpath(file['file']))
+                size += file['bytes']
+
+            with self.lock:
+                results[table] = {'rows': rows, 'bytes': size, 'files': files}
+            self.report(table, rows, size)
+            lg.info(f'dump:{database}.{table}:{rows} rows, {size} bytes, {len(files)} files')
+
+        try:
+            # A brief global read lock makes the table list, the schema and every worker snapshot start at the
+            # same point in time.
+            locked = coordinator.execute('FLUSH TABLES WITH READ LOCK;') is not None
+            if not locked:
+                lg.warning('dump:Could not take a global read lock, table snapshots may differ in time')
+
+            sql = "SELECT TABLE_NAME FROM information_schema.TABLES " \
+                  "WHERE TABLE_SCHEMA=%s AND TABLE_TYPE='BASE TABLE' ORDER BY TABLE_NAME;"
+            coordinator.execute(sql, (database,))
+            tables = [row[0] for row in coordinator.fetchall() or ()]
+
+            schema = []
+            for table in tables:
+                coordinator.execute(f'SHOW CREATE TABLE `{table}`;')
+                schema.append(coordinator.fetchone()[1] + ';')
+
+            connections = self.open(database, max(1, min(self.workers, len(tables))))
+            for db in connections:
+                db.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+                db.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT;')
+            if locked:
+                coordinator.execute('UNLOCK TABLES;')
+
+            with open(path.joinpath('schema.sql'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(schema) + '\n')
+
+            self.run_workers(connections, tables, dump_table)
+        finally:
+            for db in connections:
+                db.commit()
+                db.connection_close()
+            coordinator.connection_close()
+
+        manifest = {
+            'database': database,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'consistent': locked,
+            'tables': {table: results.get(table) for table in tables},
+            'rows': sum(result['rows'] for result in results.values()),
+            'bytes': sum(result['bytes'] for result in results.values()),
+            'seconds': round(time.time() - start, 3),
+            'errors': self.errors,
+        }
+        manifest['complete'] = not self.errors and self.verify(path, manifest)
+
+        with open(path.joinpath('manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        lg.info(f"dump:{database}:{manifest['rows']} rows, {manifest['bytes']} bytes, complete={manifest['complete']}")
+        manifest['path'] = str(path)
+        return manifest
+
+    @staticmethod
+    def verify(path, manifest):
+        path = Path(path)
+        for table, result in manifest['tables'].items():
+            if not result:
+                lg.error(f'verify:{table}:Table was not dumped')
+                return False
+            for file in result['files']:
+                name = path.joinpath(file['file'])
+                if not name.exists() or file_digest(name) != file['sha256']:
+                    lg.error(f"verify:{file['file']}:Missing or checksum mismatch")
+                    return False
+        return True
+
+    def restore(self, path, database=None):
+        start = time.time()
+        path = Path(path)
+        self.errors = []
+
+        with open(path.joinpath('manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        database = database or manifest['database']
+
+        if not manifest.get('complete') or not self.verify(path, manifest):
+            lg.error(f'restore:{path}:Backup is incomplete or corrupt')
+            return
+
+        coordinator = self.open(database, 1)[0]
+        coordinator.execute('SET FOREIGN_KEY_CHECKS=0;')
+        with open(path.joinpath('schema.sql'), encoding='utf-8') as f:
+            statements = [statement.strip() for statement in f.read().split(';\n') if statement.strip()]
+        for table in manifest['tables']:
+            coordinator.execute(f'DROP TABLE IF EXISTS `{table}`;')
+        for statement in statements:
+            coordinator.execute(statement)
+        coordinator.connection_close()
+
+        files = [(table, file) for table, result in manifest['tables'].items() for file in result['files']]
+        connections = self.open(database, max(1, min(self.workers, len(files))))
+        restored = {}
+
+        def restore_file(db, task):
+            table, file = task
+            rows = 0
+            try:
+                with gzip.open(path.joinpath(file['file']), 'rt', encoding='utf-8') as f:
+                    for statement in f:
+                        count = db.execute(statement)
+                        if count is None:
+                            raise RuntimeError(f"Statement failed in {file['file']}")
+                        rows += count
+                db.commit()
+            except Exception:
+                db.conn.rollback()
+                raise
+
+            with self.lock:
+                restored[table] = restored.get(table, 0) + rows
+            self.report(table, restored[table], file['bytes'])
+
+        for db in connections:
+            db.set_autocommit(autocommit=False)
+            db.execute('SET FOREIGN_KEY_CHECKS=0;')
+            db.execute('SET UNIQUE_CHECKS=0;')
+
+        try:
+            self.run_workers(connections, files, restore_file)
+        finally:
+            for db in connections:
+                db.connection_close()
+
+        mismatched = [table for table, result in manifest['tables'].items()
+                      if restored.get(table, 0) != result['rows']]
+        result = {
+            'database': database,
+            'rows': sum(restored.values()),
+            'bytes': sum(file['bytes'] for _, file in files),
+            'seconds': round(time.time() - start, 3),
+            'errors': self.errors,
+            'mismatched': mismatched,
+            'complete': not self.errors and not mismatched,
+        }
+        lg.info(f"restore:{database}:{result['rows']} rows, complete={result['complete']}")
+        return result
@@ -4,10 +4,18 @@
 #  Author: Dan Huckson, https://github.com/unodan
 ########################################################################################################################
 import os
+import re
+import sys
 import time
+import codecs
 import logging as lg
 
-from pymysql import connect
+from math import cos, radians
+from time import perf_counter
+from random import random
+from threading import Condition, Lock
+from contextlib import contextmanager
+from collections import OrderedDict
 
 version = '0.1'
 
@@ -22,42 +30,128 @@ class MariaDB:
         self.db_user = None
         self.db_password = None
         self.charset = None
-
-        log_file = kwargs.get('log_file', 'maria.log')
-        log_level = kwargs.get('log_level', lg.DEBUG)
-        log_format = kwargs.get('log_format', '%(levelname)s:%(name)s:%(asctime)s:%(message)s')
-        log_datefmt = kwargs.get('log_datefmt', '%Y/%m/%d %I:%M:%S')
-
-        lg.basicConfig(filename=log_file, level=log_level, format=log_format, datefmt=log_datefmt)
+        self.local_infile = False
+        self.pending = False
+        self.create_missing = True
+        self.replicas = None
+        self.routed = None
+        self.read_your_writes = 0
+        self.last_write = 0
+        self.schema = {}
+        self.catalogs = {}
+        self.databases = None
+        self.sql_cache = {}
+        self.max_allowed_packet = None
+        self.prepared = kwargs.get('prepared', False)
+        self.instrument = kwargs.get('instrument')
+        self.result_cache = kwargs.get('result_cache')
+        self.statements = StatementCache(kwargs.get('statement_cache_size', 100))
+        self.autocommit = True
+        self.tx_depth = 0
+        self.tx_error = None
+        self.journal = None
+        self.commit_every = None
+        self.tx_retries = kwargs.get('tx_retries', 3)
+        self.tx_backoff = kwargs.get('tx_backoff', 0.05)
+        self.session_vars = {}
+        self.last_error = None
+        self.reconnects = 0
+        self.replay_writes = kwargs.get('replay_writes', False)
+        self.reconnect_retries = kwargs.get('reconnect_retries', 5)
+        self.reconnect_backoff = kwargs.get('reconnect_backoff', 0.5)
+        self.reconnect_max_delay = kwargs.get('reconnect_max_delay', 30)
+        self.breaker = CircuitBreaker(kwargs.get('circuit_threshold', 5), kwargs.get('circuit_reset', 30))
+
+        # Logging is left to the application unless one of the log_* options asks for it.
+        if any(name in kwargs for name in ('log_file', 'log_level', 'log_format', 'log_datefmt')):
+            log_file = kwargs.get('log_file', 'maria.log')
+            log_level = kwargs.get('log_level', lg.DEBUG)
+            log_format = kwargs.get('log_format', '%(levelname)s:%(name)s:%(asctime)s:%(message)s')
+            log_datefmt = kwargs.get('log_datefmt', '%Y/%m/%d %I:%M:%S')
+
+            lg.basicConfig(filename=log_file, level=log_level, format=log_format, datefmt=log_datefmt)
         lg.info('__init__:Object created')
 
+    @property
+    def conn(self):
+        if self.pending:
+            self.pending = False
+            if not self.establish(self.db_name, self.create_missing):
+                raise ConnectionError(f'Could not connect to {self.host}:{self.port}')
+        return self._conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._conn = conn
+
+    @property
+    def cursor(self):
+        if self.pending:
+            self.conn
+        # After a read was routed to a replica, the rows are on that replica's cursor.
+        if self.routed is not None:
+            return self.routed.cursor
+        return self._cursor
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self._cursor = cursor
+
     def use(self, database, **kwargs):
         database = kwargs.get('database', database)
 
         sql = f'USE {database}'
         try:
-            self.cursor.execute(sql)
+            self._execute('use', sql)
             self.db_name = database
+            if self.replicas:
+                for replica in self.replicas.replicas:
+                    replica.use(database)
             self.set_autocommit(autocommit=kwargs.get('autocommit', True))
-            lg.info(f'use:{sql}')
+            lg.info('use:%s', sql)
             return True
         except Exception as err:
             lg.error(f'use:{str(err)}:{sql}')
 
-    def dump(self, database):
+    def dump(self, database, path=None, **kwargs):
+        from db_backup import Backup
+
         try:
-            t = time.strftime('%Y-%m-%d_%H:%M:%S')
-            os.popen('mysqldump -u %s -p%s -h %s -e --opt -c %s | gzip -c > %s.gz' % (
-                self.db_user, self.db_password, self.host, database, database + '_' + t))
-            lg.info('dump:' + database + '_' + t + '.gz')
-            return True
+            return Backup(self, **kwargs).dump(database, path)
         except Exception as err:
             lg.error('dump:' + str(err))
 
+    def restore(self, path, database=None, **kwargs):
+        from db_backup import Backup
+
+        try:
+            return Backup(self, **kwargs).restore(path, database)
+        except Exception as err:
+            lg.error('restore:' + str(err))
+
+    def get_connection_info(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'user': self.db_user,
+            'password': self.db_password,
+            'charset': self.charset,
+            'local_infile': self.local_infile,
+        }
+
     def connection_close(self):
+        if self.pending:
+            self.pending = False
+            self.db_name = None
+            return True
+
         try:
-            self.cursor.connection_close()
-            self.conn.connection_close()
+            if self.replicas:
+                self.replicas.close()
+                self.replicas = None
+            self.routed = None
+            self._cursor.close()
+            self.conn.close()
             self.conn = None
             self.cursor = None
             lg.info(f'close:Closed database ({self.db_name})')
@@ -84,17 +178,27 @@ class MariaDB:
         self.db_user = info['user']
         self.db_password = info['password']
         self.charset = info.get('charset', None)
+        self.local_infile = info.get('local_infile', False)
 
         database = self.db_name = kwargs.get('database', database)
+        create = self.create_missing = kwargs.get('create_database', True)
 
-        try:
-            self.conn = connect(
-                host=self.host, port=self.port,
-                user=self.db_user, passwd=self.db_password, charset=self.charset)
+        if kwargs.get('replicas'):
+            self.read_your_writes = kwargs.get('read_your_writes', 0)
+            self.replicas = ReplicaSet(database, kwargs['replicas'], **{'instrument': self.instrument, **kwargs})
+
+        if kwargs.get('lazy'):
+            # Nothing is sent to the server until a statement first needs the connection.
+            self.pending = True
+            lg.info(f'connect:Deferred until first use:(host={self.host}, port={self.port}, database={database})')
+            return True
+        return self.establish(database, create)
 
-            self.cursor = self.conn.cursor()
+    def establish(self, database, create=True):
+        try:
+            self.open()
 
-            if database:
+            if database and create:
                 if not self.database_exist(database):
                     self.create_database(database)
             self.use(database)
@@ -111,11 +215,328 @@ class MariaDB:
 
     def execute(self, sql, args=None):
         try:
-            lg.info(f'execute:{sql}')
-            return self.cursor.execute(sql, args)
+            lg.info('execute:%s', sql)
+            return self._execute('execute', sql, args)
         except Exception as err:
             lg.error(f'execute:{str(err)}:{sql}')
 
+    def route(self, sql):
+        if not self.replicas or self.journal is not None or self.tx_depth or not self.autocommit:
+            return
+        if self.read_your_writes and time.time() - self.last_write < self.read_your_writes:
+            return
+        if is_read(sql):
+            return self.replicas.choose()
+
+    def _execute(self, method, sql, args=None):
+        self.routed = None
+        if self.replicas:
+            replica = self.route(sql)
+            if replica is not None:
+                start = perf_counter()
+                try:
+                    result = replica._execute(method, sql, args)
+                    self.replicas.record(replica, perf_counter() - start)
+                    self.routed = replica
+                    return result
+                except Exception as err:
+                    # A bad statement would fail on the primary too. Only a replica that is down or overloaded
+                    # is ejected, the primary can always answer the read.
+                    if not is_unavailable(err):
+                        self.last_error = err
+                        raise
+                    self.replicas.eject(replica, err)
+            elif _write.match(sql):
+                self.last_write = time.time()
+
+        if not self.breaker.allow():
+            self.last_error = CircuitOpenError(f'Circuit open, not sending {method} to {self.host}:{self.port}')
+            raise self.last_error
+
+        try:
+            result = self._run(method, sql, args)
+        except Exception as err:
+            try:
+                if is_disconnect(err):
+                    self.breaker.failure()
+                    result = self.recover(method, sql, args, err)
+                elif self.journal is not None and error_code(err) in _retry_codes:
+                    result = self.replay(method, sql, args, err)
+                else:
+                    raise
+            except Exception as err:
+                self.last_error = err
+                if self.journal is not None:
+                    self.tx_error = self.tx_error or err
+                raise
+        self.breaker.success()
+
+        if self.result_cache is not None:
+            self.result_cache.invalidate_sql(sql)
+        if _ddl.match(sql):
+            self.invalidate_ddl(sql)
+
+        if self.journal is None:
+            return result
+
+        self.journal.append((method, sql, args))
+        if self.commit_every and self.tx_depth == 1 and len(self.journal) >= self.commit_every:
+            self.conn.commit()
+            self.journal.clear()
+            lg.info('batch:commit')
+        return result
+
+    def recover(self, method, sql, args, err):
+        lg.warning('recover:%s:%s', method, err)
+        self.reconnect()
+
+        if self.journal is not None:
+            # The server rolled the open transaction back with the old session, so it is rebuilt from the journal.
+            self.conn.autocommit(False)
+            self.conn.begin()
+            for entry in self.journal:
+                self._run(*entry)
+            return self._run(method, sql, args)
+
+        if self.replay_writes or is_idempotent(sql):
+            return self._run(method, sql, args)
+        raise err
+
+    def reconnect(self):
+        err = None
+        for attempt in range(1, self.reconnect_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f'Circuit open, not reconnecting to {self.host}:{self.port}')
+
+            delay = min(self.reconnect_max_delay, self.reconnect_backoff * 2 ** (attempt - 1)) * random()
+            time.sleep(delay)
+            try:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.open()
+
+                # Restore the session as the application last configured it.
+                if self.db_name:
+                    self.conn.select_db(self.db_name)
+                self.conn.autocommit(self.autocommit)
+                for name, value in self.session_vars.items():
+                    self.cursor.execute(f'SET SESSION {name}=%s;', (value,))
+                # Prepared statements died with the old session.
+                self.statements.reset(self.conn.thread_id())
+
+                self.breaker.success()
+                self.reconnects += 1
+                lg.info(f'reconnect:Reconnected to {self.host}:{self.port} after {attempt} attempt(s)')
+                return True
+            except Exception as retry_err:
+                err = retry_err
+                self.breaker.failure()
+                lg.warning('reconnect:Attempt %s/%s failed:%s', attempt, self.reconnect_retries, retry_err)
+        raise err
+
+    def open(self):
+        from pymysql import connect
+
+        self.conn = connect(
+            host=self.host, port=self.port,
+            user=self.db_user, passwd=self.db_password, charset=self.charset,
+            local_infile=self.local_infile)
+        self.cursor = self.conn.cursor()
+
+    def set_session(self, name, value):
+        sql = f'SET SESSION {name}=%s;'
+        try:
+            lg.info('set_session:%s', sql)
+            result = self._execute('set_session', sql, (value,))
+            self.session_vars[name] = value
+            return result
+        except Exception as err:
+            lg.error(f'set_session:{str(err)}:{sql}')
+
+    def get_circuit_state(self):
+        return self.breaker.get_state()
+
+    def get_replica_stats(self):
+        if self.replicas:
+            return self.replicas.get_stats()
+
+    def replay(self, method, sql, args, err):
+        # InnoDB rolls back the whole transaction on a deadlock, so the statements run since the last
+        # commit are replayed in order, then the one that failed.
+        for attempt in range(1, self.tx_retries + 1):
+            delay = self.tx_backoff * 2 ** (attempt - 1) * (1 + random())
+            lg.warning('transaction:%s:Retry %s/%s in %.3fs', err, attempt, self.tx_retries, delay)
+            self.conn.rollback()
+            time.sleep(delay)
+            try:
+                for entry in self.journal:
+                    self._run(*entry)
+                return self._run(method, sql, args)
+            except Exception as retry_err:
+                if error_code(retry_err) not in _retry_codes:
+                    raise
+                err = retry_err
+        raise err
+
+    @contextmanager
+    def transaction(self):
+        if self.tx_depth:
+            savepoint = f'sp_{self.tx_depth}'
+            self.tx_depth += 1
+            self._execute('transaction', f'SAVEPOINT {savepoint};')
+            mark = len(self.journal)
+            try:
+                yield self
+                if self.tx_error:
+                    raise self.tx_error
+            except BaseException:
+                self.tx_error = None
+                self._run('transaction', f'ROLLBACK TO SAVEPOINT {savepoint};')
+                del self.journal[mark:]
+                raise
+            else:
+                self._execute('transaction', f'RELEASE SAVEPOINT {savepoint};')
+            finally:
+                self.tx_depth -= 1
+            return
+
+        self.tx_depth = 1
+        self.tx_error = None
+        self.journal = []
+        self.conn.autocommit(False)
+        self.conn.begin()
+        try:
+            yield self
+            if self.tx_error:
+                raise self.tx_error
+            self.conn.commit()
+            lg.info('transaction:commit')
+        except BaseException as err:
+            self.conn.rollback()
+            lg.error(f'transaction:rollback:{str(err)}')
+            raise
+        finally:
+            self.tx_depth = 0
+            self.tx_error = None
+            self.journal = None
+            self.commit_every = None
+            self.conn.autocommit(self.autocommit)
+
+    @contextmanager
+    def batch(self, commit_every=1000):
+        if self.tx_depth:
+            raise RuntimeError('batch:Cannot start a batch inside a transaction')
+
+        with self.transaction():
+            self.commit_every = commit_every
+            yield self
+
+    def _run(self, method, sql, args=None):
+        execute = self._run_prepared if method == 'execute_prepared' else self.cursor.execute
+        if not self.instrument:
+            return execute(sql, args)
+
+        start = perf_counter()
+        try:
+            result = execute(sql, args)
+        except Exception:
+            self.instrument.record(method, sql, args, perf_counter() - start, None, error=True)
+            raise
+        self.instrument.record(method, sql, args, perf_counter() - start, self.cursor.rowcount)
+        return result
+
+    def _fetch(self, method, sql, args=None, ttl=None):
+        cache = self.result_cache
+        # Inside a transaction the rows may include uncommitted writes, or miss them if served from the cache.
+        if cache is None or self.journal is not None or not self.autocommit:
+            self._execute(method, sql, args)
+            return self.cursor.fetchall()
+
+        key = cache.key(self.db_name, sql, args)
+        rows = cache.get(key)
+        if rows is None:
+            self._execute(method, sql, args)
+            rows = self.cursor.fetchall()
+            cache.put(key, sql, rows, ttl)
+        return rows
+
+    def query(self, sql, args=None, ttl=None):
+        try:
+            lg.info('query:%s', sql)
+            return self._fetch('query', sql, args, ttl)
+        except Exception as err:
+            lg.error(f'query:{str(err)}:{sql}')
+
+    def enable_result_cache(self, **kwargs):
+        self.result_cache = QueryCache(**kwargs)
+        return self.result_cache
+
+    def get_result_cache_stats(self):
+        if self.result_cache:
+            return self.result_cache.get_stats()
+
+    def prepare(self, sql):
+        thread_id = self.conn.thread_id()
+        if self.statements.thread_id != thread_id:
+            # Server-side statements die with the session, so a reconnect means starting over.
+            self.statements.reset(thread_id)
+
+        name = self.statements.get(sql)
+        if name:
+            return name
+
+        name = self.statements.next_name()
+        lg.info('prepare:%s:%s', name, sql)
+        self.cursor.execute(f'PREPARE {name} FROM %s;', (sql.rstrip().rstrip(';').replace('%s', '?'),))
+        for evicted in self.statements.put(sql, name):
+            self.cursor.execute(f'DEALLOCATE PREPARE {evicted};')
+        return name
+
+    def execute_prepared(self, sql, args=None):
+        try:
+            # Journalled, replayed and cached as the statement itself, the PREPARE/SET/EXECUTE round trips
+            # belong to one session and are redone by _run on whichever session runs it.
+            return self._execute('execute_prepared', sql, args)
+        except Exception as err:
+            lg.error(f'execute_prepared:{str(err)}:{sql}')
+
+    def _run_prepared(self, sql, args=None):
+        try:
+            return self._execute_statement(self.prepare(sql), args)
+        except Exception as err:
+            if error_code(err) != _unknown_statement:
+                raise
+            # The server no longer knows the statement (e.g. the session was replaced), so it is prepared again.
+            lg.warning(f'execute_prepared:{str(err)}:Preparing again')
+            self.statements.reset(self.conn.thread_id())
+            return self._execute_statement(self.prepare(sql), args)
+
+    def _execute_statement(self, name, args=None):
+        if not args:
+            return self.cursor.execute(f'EXECUTE {name};')
+
+        params = [f'@p{i}' for i in range(len(args))]
+        self.cursor.execute(f"SET {', '.join(f'{param}=%s' for param in params)};", tuple(args))
+        return self.cursor.execute(f"EXECUTE {name} USING {', '.join(params)};")
+
+    def run_statement(self, sql, args=None, method='run_statement'):
+        if self.prepared:
+            return self.execute_prepared(sql, args)
+        return self._execute(method, sql, args)
+
+    def deallocate_statements(self):
+        try:
+            for name in self.statements.clear():
+                self._execute('deallocate_statements', f'DEALLOCATE PREPARE {name};')
+            return True
+        except Exception as err:
+            lg.error(f'deallocate_statements:{str(err)}')
+
+    def get_statement_stats(self):
+        return self.statements.get_stats()
+
     def fetchone(self):
         try:
             return self.cursor.fetchone()
@@ -128,19 +549,124 @@ class MariaDB:
         finally:
             pass
 
+    def iter_query(self, sql, args=None, chunk_size=None):
+        from pymysql.cursors import SSCursor
+
+        cursor = (self.route(sql) or self).conn.cursor(SSCursor)
+        start = perf_counter()
+        count = 0
+        error = False
+        try:
+            lg.info('iter_query:%s', sql)
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(chunk_size or 1000)
+                if not rows:
+                    break
+                count += len(rows)
+                if chunk_size:
+                    yield rows
+                else:
+                    yield from rows
+        except Exception as err:
+            # Re-raised, a stream that just stopped would look like a complete result to the consumer.
+            error = True
+            lg.error(f'iter_query:{str(err)}:{sql}')
+            raise
+        finally:
+            if self.instrument:
+                self.instrument.record('iter_query', sql, args, perf_counter() - start, count, error=error)
+            # Closing an unbuffered cursor reads and discards any rows the consumer did not take,
+            # which keeps the connection usable if the generator is abandoned early.
+            cursor.close()
+
+    def fetch_columns(self, sql, args=None, dtypes=None, chunk_size=10000, **kwargs):
+        import numpy as np
+        from pymysql.cursors import SSCursor
+
+        max_categories = kwargs.get('max_categories', 1024)
+        dtypes = dtypes or {}
+
+        cursor = (self.route(sql) or self).conn.cursor(SSCursor)
+        try:
+            lg.info('fetch_columns:%s', sql)
+            cursor.execute(sql, args)
+            names = [column[0] for column in cursor.description]
+            columns = []
+            for name, type_code in zip(names, (column[1] for column in cursor.description)):
+                dtype = dtypes.get(name) or _numpy_types.get(type_code)
+                columns.append(ColumnBuffer(np, dtype, chunk_size, max_categories))
+
+            count = 0
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values, count)
+                count += len(rows)
+        except Exception as err:
+            lg.error(f'fetch_columns:{str(err)}:{sql}')
+            return
+        finally:
+            cursor.close()
+
+        result = {name: column.finish(count) for name, column in zip(names, columns)}
+        if kwargs.get('records'):
+            arrays = [value.decode() if isinstance(value, Categorical) else value for value in result.values()]
+            return np.rec.fromarrays(arrays, names=names)
+        return result
+
+    def within_bbox(self, table, south, west, north, east, columns='*', **kwargs):
+        latitude = kwargs.get('latitude', 'latitude')
+        longitude = kwargs.get('longitude', 'longitude')
+        limit = kwargs.get('limit')
+
+        where, args = bbox_condition(latitude, longitude, south, west, north, east)
+        sql = f'SELECT {columns} FROM {table} WHERE {where}'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return self.query(sql + ';', args, kwargs.get('ttl'))
+
+    def within_radius(self, table, lat, lon, radius, columns='*', **kwargs):
+        latitude = kwargs.get('latitude', 'latitude')
+        longitude = kwargs.get('longitude', 'longitude')
+        limit = kwargs.get('limit')
+
+        # The bounding box is answered from the (latitude, longitude) index, the exact distance only
+        # has to be computed for the rows inside it.
+        where, args = bbox_condition(latitude, longitude, *bounding_box(lat, lon, radius))
+        distance = haversine_sql(latitude, longitude)
+        sql = f'SELECT {columns}, {distance} AS distance FROM {table} WHERE {where} ' \
+              f'HAVING distance <= %s ORDER BY distance'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return self.query(sql + ';', (lat, lat, lon) + args + (radius,), kwargs.get('ttl'))
+
+    def nearest(self, table, lat, lon, count=10, columns='*', **kwargs):
+        radius = kwargs.pop('radius', 25)
+        count = kwargs.pop('limit', None) or count
+        while True:
+            rows = self.within_radius(table, lat, lon, radius, columns, limit=count, **kwargs)
+            if rows is None or len(rows) >= count or radius >= _earth_radius * 3.2:
+                return rows
+            radius *= 4
+
     def drop_table(self, table):
         sql = f'DROP TABLE {table}'
         try:
-            lg.info(f'drop_table:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('drop_table:%s', sql)
+            self.invalidate_schema(table)
+            return self._execute('drop_table', sql)
         except Exception as err:
             lg.error(f'drop_table:{str(err)}:{sql}')
 
     def drop_index(self, table, index):
         sql = f'DROP INDEX {index} ON {table};'
         try:
-            lg.info(f'drop_index:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('drop_index:%s', sql)
+            self.invalidate_schema(table)
+            return self._execute('drop_index', sql)
         except Exception as err:
             lg.error(f'drop_index:{str(err)}:{sql}')
 
@@ -148,8 +674,10 @@ class MariaDB:
         database = kwargs.get('database', database)
         sql = f'DROP DATABASE {database};'
         try:
-            lg.info(f'drop_database:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('drop_database:%s', sql)
+            self.invalidate_schema(database=database)
+            self.databases = None
+            return self._execute('drop_database', sql)
         except Exception as err:
             lg.error(f'drop_database:{str(err)}:{sql}')
 
@@ -160,16 +688,37 @@ class MariaDB:
         sql = f'CREATE TABLE {table} ({sql}) ENGINE=%s'
         try:
             lg.info('create_table:' + sql)
+            self.invalidate_schema(table, database=database)
             if database == self.db_name:
-                return self.cursor.execute(sql, (database_engine,))
+                return self._execute('create_table', sql, (database_engine,))
         except Exception as err:
             lg.error(f'create_table:{str(err)}:{sql}')
 
+    @contextmanager
+    def bulk_load(self, **kwargs):
+        foreign_key_checks = kwargs.get('foreign_key_checks', False)
+        unique_checks = kwargs.get('unique_checks', False)
+
+        loader = BulkLoad(self, **kwargs)
+        if not foreign_key_checks:
+            self.set_session('foreign_key_checks', 0)
+        if not unique_checks:
+            self.set_session('unique_checks', 0)
+        try:
+            yield loader
+            loader.finish_all()
+        finally:
+            if not foreign_key_checks:
+                self.set_session('foreign_key_checks', 1)
+            if not unique_checks:
+                self.set_session('unique_checks', 1)
+
     def create_index(self, table, column, index):
         sql = f'CREATE INDEX {index} ON {table}({column});'
         try:
-            lg.info(f'create_index:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('create_index:%s', sql)
+            self.invalidate_schema(table)
+            return self._execute('create_index', sql)
         except Exception as err:
             lg.error(f'create_index:{str(err)}:{sql}')
 
@@ -178,22 +727,30 @@ class MariaDB:
 
         sql = f'CREATE DATABASE {database};'
         try:
-            lg.info(f'create_database:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('create_database:%s', sql)
+            self.databases = None
+            return self._execute('create_database', sql)
         except Exception as err:
             lg.error(f'create_database:{str(err)}:{sql}')
 
     def row_exist(self, table, _id):
         sql = f'SELECT id FROM {table} WHERE id=%s;'
-        if self.execute(sql, (_id,)):
+        if self.prepared:
+            if self.execute_prepared(sql, (_id,)):
+                return self.fetchone()
+        elif self.execute(sql, (_id,)):
             return self.fetchone()
 
     def table_exist(self, table, **kwargs):
         database = kwargs.get('database', self.db_name)
+        catalog = self.catalogs.get(database)
+        if catalog:
+            return catalog.table_exist(table)
+
         sql = 'SELECT table_name FROM information_schema.tables WHERE table_schema=%s AND table_name=%s;'
 
         try:
-            self.cursor.execute(sql, (database, table))
+            self._execute('table_exist', sql, (database, table))
             return self.cursor.fetchone()
         except Exception as err:
             lg.error(f'table_exist:{str(err)}')
@@ -201,18 +758,16 @@ class MariaDB:
     def index_exist(self, table, index, **kwargs):
         result = False
         database = kwargs.get('database', self.db_name)
+        catalog = self.catalogs.get(database)
+        if catalog:
+            return catalog.index_exist(table, index)
 
         if database:
             sql = f'SELECT 1 FROM information_schema.statistics WHERE table_schema="{database}" AND ' \
                   f'table_name="{table}" AND index_name="{index}";'
             try:
-                if database == self.db_name and self.cursor.execute(sql):
+                if self._execute('index_exist', sql):
                     result = self.cursor.fetchone()
-                else:
-                    self.use(database)
-                    if self.cursor.execute(sql):
-                        result = self.cursor.fetchone()
-                    self.use(database)
             except Exception as err:
                 lg.error(f'index_exist:{str(err)}')
 
@@ -220,10 +775,12 @@ class MariaDB:
 
     def database_exist(self, database, **kwargs):
         database = kwargs.get('database', database)
+        if self.databases is not None:
+            return database in self.databases or None
 
         sql = 'SHOW DATABASES;'
         try:
-            self.cursor.execute(sql)
+            self._execute('database_exist', sql)
             for row in self.cursor.fetchall():
                 if database in row:
                     return True
@@ -231,75 +788,280 @@ class MariaDB:
             lg.error(f'database_exist:{str(err)}')
 
     def insert_row(self, table, row):
-        column_names = []
+        sql = self.get_sql(table, 'insert_row')
+        try:
+            lg.info('insert_row:%s', sql)
+            return self.run_statement(sql, row, 'insert_row')
+        except Exception as err:
+            lg.error(f'insert_row:{str(err)}:{sql}:{row}')
+
+    def insert_rows(self, table, rows, batch_size=1000, **kwargs):
+        mode = kwargs.get('mode')
+        commit = kwargs.get('commit', False)
+        # Callers that track progress (checkpoints, row hashes) need a failed batch to stop them.
+        raise_errors = kwargs.get('raise_errors', False)
+
+        column_names = self.get_column_names(table)[1:]
+        if not column_names:
+            lg.error(f'insert_rows:No columns found for table {table}')
+            if raise_errors:
+                raise LookupError(f'insert_rows:No columns found for table {table}')
+            return
+
+        if mode == 'ignore':
+            head = f"INSERT IGNORE INTO {table} ({','.join(column_names)}) VALUES "
+            tail = ';'
+        elif mode == 'update':
+            head = f"INSERT INTO {table} ({','.join(column_names)}) VALUES "
+            tail = f" ON DUPLICATE KEY UPDATE {','.join(f'{name}=VALUES({name})' for name in column_names)};"
+        else:
+            head = f"INSERT INTO {table} ({','.join(column_names)}) VALUES "
+            tail = ';'
+
+        placeholder = f"({('%s,' * len(column_names)).rstrip(',')})"
+        max_size = self.get_max_allowed_packet() - len(head) - len(tail) - 1024
+
+        total = 0
+        values = []
+        size = 0
+
+        def flush():
+            sql = head + ','.join(values) + tail
+            try:
+                lg.info(f'insert_rows:{head}... ({len(values)} rows)')
+                count = self._execute('insert_rows', sql)
+                if commit:
+                    self.conn.commit()
+                return count
+            except Exception as err:
+                lg.error(f'insert_rows:{str(err)}:{head}... ({len(values)} rows)')
+                if raise_errors:
+                    raise
+                return 0
+
+        for row in rows:
+            value = self.cursor.mogrify(placeholder, tuple(row))
+            length = len(value.encode()) + 1
+            if values and (len(values) >= batch_size or size + length > max_size):
+                total += flush()
+                values = []
+                size = 0
+
+            values.append(value)
+            size += length
+
+        if values:
+            total += flush()
+
+        return total
+
+    def load_csv(self, table, path, columns=None, encoding='utf-8', transforms=None, **kwargs):
+        joins = kwargs.get('joins', '')
+        where = kwargs.get('where', '')
+        mode = kwargs.get('mode')
+        delimiter = kwargs.get('delimiter', ',')
+        quotechar = kwargs.get('quotechar', '"')
+        line_terminator = kwargs.get('line_terminator', '\n')
 
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
+        try:
+            codec = codecs.lookup(encoding).name
+        except LookupError:
+            lg.error(f'load_csv:Unknown encoding {encoding}:{path}')
+            return
+
+        charset = _charsets.get(codec)
+        transcoded = None
+        if charset is None or (codec == 'utf-8-sig' and has_bom(path)):
+            # LOAD DATA cannot read e.g. UTF-16/32 and would keep a BOM in the first field, such files are
+            # rewritten as UTF-8 first.
+            try:
+                path = transcoded = transcode(path, encoding)
+                charset = 'utf8mb4'
+            except Exception as err:
+                lg.error(f'load_csv:Could not transcode {path} from {encoding}:{str(err)}')
+                return
+
+        target_columns = self.get_column_names(table)[1:]
+        if not columns:
+            columns = target_columns
+        if not transforms:
+            transforms = {name: f's.{name}' for name in target_columns if name in columns}
 
-        sql = f"INSERT INTO {table} ({','.join(column_names[1:])}) VALUES ({('%s,' * len(row)).rstrip(',')});"
+        stage = f'{table}_stage'
+        ignore = ' IGNORE' if mode == 'ignore' else ''
+        result = {'table': table, 'file': str(path), 'loaded': 0, 'inserted': 0, 'seconds': 0}
+
+        start = time.time()
+        sql = f"CREATE TEMPORARY TABLE {stage} ({', '.join(f'`{name}` TEXT' for name in columns)});"
         try:
-            lg.info(f'insert_row:{sql}')
-            return self.cursor.execute(sql, row)
+            lg.info('load_csv:%s', sql)
+            self._execute('load_csv', sql)
+
+            sql = f"LOAD DATA LOCAL INFILE %s INTO TABLE {stage} CHARACTER SET {charset} " \
+                  f"FIELDS TERMINATED BY %s OPTIONALLY ENCLOSED BY %s " \
+                  f"LINES TERMINATED BY %s ({', '.join(f'`{name}`' for name in columns)});"
+            lg.info('load_csv:%s', sql)
+            result['loaded'] = self._execute('load_csv', sql, (str(path), delimiter, quotechar, line_terminator))
+
+            sql = f"INSERT{ignore} INTO {table} ({', '.join(transforms)}) " \
+                  f"SELECT {', '.join(transforms.values())} FROM {stage} s {joins}"
+            if where:
+                sql += f' WHERE {where}'
+            lg.info('load_csv:%s', sql)
+            result['inserted'] = self._execute('load_csv', sql + ';')
         except Exception as err:
-            lg.error(f'insert_row:{str(err)}:{sql}:{row}')
+            lg.error(f'load_csv:{str(err)}:{sql}')
+            result = None
+        finally:
+            try:
+                self._execute('load_csv', f'DROP TEMPORARY TABLE IF EXISTS {stage};')
+            except Exception as err:
+                lg.error(f'load_csv:{str(err)}')
+            if transcoded:
+                os.remove(transcoded)
+
+        if result:
+            result['seconds'] = round(time.time() - start, 3)
+            lg.info(f"load_csv:{table}:loaded={result['loaded']}, inserted={result['inserted']}, "
+                    f"seconds={result['seconds']}")
+        return result
 
-    def update_row(self, table, _id, *args):
-        column_names = []
+    def build_lookup(self, table, key_columns, value_column='id', **kwargs):
+        return Lookup(self, table, key_columns, value_column, **kwargs)
 
-        data = args[0]
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
+    def get_max_allowed_packet(self):
+        if not self.max_allowed_packet:
+            self.max_allowed_packet = 1024 * 1024
+            try:
+                self._execute('get_max_allowed_packet', 'SELECT @@max_allowed_packet;')
+                self.max_allowed_packet = int(self.cursor.fetchone()[0])
+            except Exception as err:
+                lg.error(f'get_max_allowed_packet:{str(err)}')
 
-        parts = ''
-        sql = f'UPDATE {table} SET '
-        for name in column_names[1:]:
-            parts += (name + '=%s,')
-        sql += (parts[:-1] + ' WHERE id=%s;')
+        return self.max_allowed_packet
+
+    def update_row(self, table, _id, *args):
+        data = args[0]
+        sql = self.get_sql(table, 'update_row')
 
         try:
-            lg.info(f'update_row:{sql}')
-            return self.cursor.execute(sql, list(data) + [_id])
+            lg.info('update_row:%s', sql)
+            return self.run_statement(sql, list(data) + [_id], 'update_row')
         except Exception as err:
             lg.error(f'update_row:{str(err)}:{sql}')
 
     def update_columns(self, table, _id, columns, data):
-        column_names = []
-
-        if not isinstance(columns, list) or not isinstance(columns, tuple):
+        if not isinstance(columns, (list, tuple)):
             columns = (columns, )
 
-        if not isinstance(data, list) or not isinstance(data, tuple):
+        if not isinstance(data, (list, tuple)):
             data = (data, )
 
-        for name in self.get_columns_metadata(table):
-            column_names.append(name[3])
-
-        sql = f'UPDATE {table} SET '
-        for column, content in zip(columns, data):
-            cname = column_names[column] if isinstance(column, int) else column
-            sql += f'{cname}=%s,'
-
-        sql = sql.rstrip(',') + ' WHERE id=%s;'
+        sql = self.get_sql(table, 'update_columns', tuple(columns))
 
         try:
-            lg.info(f'update_row:{sql}')
-            return self.cursor.execute(sql, list(data) + [_id])
+            lg.info('update_row:%s', sql)
+            return self.run_statement(sql, list(data) + [_id], 'update_columns')
         except Exception as err:
             lg.error(f'update_row:{str(err)}:{sql}')
 
     def delete_row(self, table, _id):
         sql = f'DELETE FROM {table} WHERE id = %s;'
         try:
-            lg.info(f'delete_row:{sql}')
-            return self.cursor.execute(sql, (_id,))
+            lg.info('delete_row:%s', sql)
+            return self.run_statement(sql, (_id,), 'delete_row')
         except Exception as err:
             lg.error(f'delete_row:{str(err)}:{sql}')
 
+    def update_where(self, table, values, where=None, args=None, **kwargs):
+        sql = f"UPDATE {table} SET {', '.join(f'{name}=%s' for name in values)}"
+        return self.run_chunked('update_where', table, sql, tuple(values.values()), where, args, **kwargs)
+
+    def delete_where(self, table, where=None, args=None, **kwargs):
+        return self.run_chunked('delete_where', table, f'DELETE FROM {table}', (), where, args, **kwargs)
+
+    def run_chunked(self, method, table, statement, values, where=None, args=None, **kwargs):
+        key = kwargs.get('key', 'id')
+        chunk_size = kwargs.get('chunk_size', 1000)
+        max_rate = kwargs.get('max_rate')
+        replicas = kwargs.get('replicas', ())
+        lag = kwargs.get('lag')
+        max_lag = kwargs.get('max_lag', 10)
+        lag_wait = kwargs.get('lag_wait', 1.0)
+        progress = kwargs.get('progress')
+        last_id = kwargs.get('start_id', 0)
+
+        # Walking the primary key keeps every chunk an index range scan and every transaction small,
+        # the WHERE condition is repeated on the change so rows that stopped matching are left alone.
+        condition = f' AND ({where})' if where else ''
+        args = tuple(args or ())
+        select = f'SELECT {key} FROM {table} WHERE {key} > %s{condition} ORDER BY {key} LIMIT {int(chunk_size)};'
+        change = f'{statement} WHERE {key} BETWEEN %s AND %s{condition};'
+
+        result = {'table': table, 'rows': 0, 'chunks': 0, 'last_id': last_id, 'seconds': 0, 'complete': False}
+        start = time.time()
+        try:
+            while True:
+                self.wait_for_replicas(replicas, lag, max_lag, lag_wait)
+
+                with self.transaction():
+                    self._execute(method, select, (last_id, ) + args)
+                    ids = self.cursor.fetchall()
+                    if ids:
+                        count = self._execute(method, change, values + (ids[0][0], ids[-1][0]) + args)
+                if not ids:
+                    break
+
+                last_id = ids[-1][0]
+                result['rows'] += count
+                result['chunks'] += 1
+                result['last_id'] = last_id
+                result['seconds'] = round(time.time() - start, 3)
+                if progress:
+                    progress(dict(result))
+
+                if max_rate:
+                    delay = result['rows'] / max_rate - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+            result['complete'] = True
+        except Exception as err:
+            result['error'] = str(err)
+            lg.error(f'{method}:{str(err)}:Resume with start_id={last_id}')
+
+        result['seconds'] = round(time.time() - start, 3)
+        lg.info(f'{method}:{result}')
+        return result
+
+    def wait_for_replicas(self, replicas=(), lag=None, max_lag=10, wait=1.0):
+        while True:
+            seconds = [replica.get_replication_lag() for replica in replicas]
+            if lag:
+                seconds.append(lag())
+
+            worst = max((value for value in seconds if value is not None), default=0)
+            if worst <= max_lag:
+                return worst
+
+            lg.warning('wait_for_replicas:Replication lag %ss is over %ss, waiting %ss', worst, max_lag, wait)
+            time.sleep(wait)
+
+    def get_replication_lag(self):
+        sql = 'SHOW SLAVE STATUS;'
+        try:
+            self._execute('get_replication_lag', sql)
+            row = self.cursor.fetchone()
+            if row:
+                fields = [column[0] for column in self.cursor.description]
+                return row[fields.index('Seconds_Behind_Master')]
+        except Exception as err:
+            lg.error(f'get_replication_lag:{str(err)}:{sql}')
+
     def get_databases(self):
         sql = 'SHOW DATABASES;'
         try:
-            self.cursor.execute(sql)
-            rows = self.cursor.fetchall()
+            rows = self._fetch('get_databases', sql)
             if rows:
                 return tuple([i[0] for i in rows])
         except Exception as err:
@@ -308,18 +1070,10 @@ class MariaDB:
     def get_tables(self, **kwargs):
         database = kwargs.get('database', self.db_name)
 
-        sql = "SHOW TABLES;"
+        sql = f"SHOW TABLES FROM `{database}`;" if database else "SHOW TABLES;"
 
         try:
-            if database == self.db_name:
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-            else:
-                db = self.db_name
-                self.use(database)
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-                self.use(db)
+            rows = self._fetch('get_tables', sql)
             if rows:
                 return tuple([i[0] for i in rows])
         except Exception as err:
@@ -327,20 +1081,15 @@ class MariaDB:
 
     def get_column_metadata(self, table, column, **kwargs):
         database = kwargs.get('database', self.db_name)
+        catalog = self.catalogs.get(database)
+        if catalog:
+            return catalog.get_column(table, column)
 
         sql = f"SELECT * FROM information_schema.COLUMNS WHERE " \
               f"TABLE_SCHEMA='{database}' AND TABLE_NAME='{table}' AND COLUMN_NAME='{column}';"
         try:
-            if database == self.db_name:
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-            else:
-                db = self.db_name
-                self.use(database)
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-                self.use(db)
-
+            self._execute('get_column_metadata', sql)
+            rows = self.cursor.fetchall()
             if rows:
                 return tuple(rows)
         except Exception as err:
@@ -348,55 +1097,1165 @@ class MariaDB:
 
     def get_columns_metadata(self, table, **kwargs):
         database = kwargs.get('database', self.db_name)
+        catalog = self.catalogs.get(database)
+        if catalog:
+            return catalog.get_columns(table)
 
         sql = f"SELECT * FROM information_schema.COLUMNS WHERE " \
               f"TABLE_SCHEMA='{database}' AND " \
               f"TABLE_NAME = '{table}';"
         try:
-            if database == self.db_name:
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-            else:
-                db = self.db_name
-                self.use(database)
-                self.cursor.execute(sql)
-                rows = self.cursor.fetchall()
-                self.use(db)
+            self._execute('get_columns_metadata', sql)
+            rows = self.cursor.fetchall()
             if rows:
                 return tuple(rows)
         except Exception as err:
             lg.error(f'get_columns_metadata:{str(err)}:{sql}')
 
+    def get_table_schema(self, table, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        key = (database, table)
+        schema = self.schema.get(key)
+        if schema:
+            return schema
+
+        catalog = self.catalogs.get(database)
+        if catalog:
+            schema = catalog.get_schema(table)
+            if schema:
+                self.schema[key] = schema
+            return schema
+
+        sql = 'SELECT COLUMN_NAME, DATA_TYPE, ORDINAL_POSITION FROM information_schema.COLUMNS ' \
+              'WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION;'
+        try:
+            self._execute('get_table_schema', sql, (database, table))
+            rows = self.cursor.fetchall()
+            if rows:
+                schema = self.schema[key] = {
+                    'names': tuple(row[0] for row in rows),
+                    'types': tuple(row[1] for row in rows),
+                    'positions': tuple(row[2] for row in rows),
+                }
+                return schema
+        except Exception as err:
+            lg.error(f'get_table_schema:{str(err)}:{sql}')
+
+    def catalog(self, database=None, refresh=False):
+        database = database or self.db_name
+        catalog = self.catalogs.get(database)
+        if catalog and not refresh:
+            return catalog
+
+        # Four set-based queries for the whole schema, instead of one query (and a use() round trip for other
+        # databases) per table_exist/index_exist/get_*_metadata/get_table_status call.
+        sql = 'SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s ORDER BY TABLE_NAME, ORDINAL_POSITION;'
+        try:
+            lg.info('catalog:%s', database)
+            self._execute('catalog', sql, (database,))
+            fields = [column[0].upper() for column in self.cursor.description]
+            columns = self.cursor.fetchall()
+
+            sql = 'SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, SEQ_IN_INDEX, COLUMN_NAME ' \
+                  'FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=%s ' \
+                  'ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;'
+            self._execute('catalog', sql, (database,))
+            statistics = self.cursor.fetchall()
+
+            sql = f'SHOW TABLE STATUS FROM `{database}`;'
+            self._execute('catalog', sql)
+            status = self.cursor.fetchall()
+
+            if self.databases is None:
+                sql = 'SHOW DATABASES;'
+                self._execute('catalog', sql)
+                self.databases = tuple(row[0] for row in self.cursor.fetchall())
+
+            catalog = self.catalogs[database] = Catalog(database, fields, columns, statistics, status)
+            lg.info(f'catalog:{database}:{len(catalog.status)} tables, {len(columns)} columns, '
+                    f'{len(catalog.indexes)} indexes')
+            return catalog
+        except Exception as err:
+            lg.error(f'catalog:{str(err)}:{sql}')
+
+    def get_column_names(self, table, **kwargs):
+        schema = self.get_table_schema(table, **kwargs)
+        if schema:
+            return schema['names']
+        return ()
+
+    def get_sql(self, table, kind, columns=None, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        key = (database, table, kind, columns)
+        sql = self.sql_cache.get(key)
+        if sql:
+            return sql
+
+        column_names = self.get_column_names(table, database=database)
+
+        if kind == 'insert_row':
+            sql = f"INSERT INTO {table} ({','.join(column_names[1:])}) " \
+                  f"VALUES ({('%s,' * len(column_names[1:])).rstrip(',')});"
+        elif kind == 'update_row':
+            sql = f"UPDATE {table} SET {','.join(name + '=%s' for name in column_names[1:])} WHERE id=%s;"
+        elif kind == 'update_columns':
+            names = [column_names[column] if isinstance(column, int) else column for column in columns]
+            sql = f"UPDATE {table} SET {','.join(name + '=%s' for name in names)} WHERE id=%s;"
+        else:
+            return
+
+        if column_names:
+            self.sql_cache[key] = sql
+        return sql
+
+    def invalidate_schema(self, table=None, **kwargs):
+        database = kwargs.get('database', self.db_name if table else None)
+
+        if not table and not database:
+            self.schema.clear()
+            self.sql_cache.clear()
+            self.catalogs.clear()
+            self.databases = None
+            return
+
+        self.catalogs.pop(database, None)
+
+        for cache in (self.schema, self.sql_cache):
+            for key in [key for key in cache if key[0] == database and (table is None or key[1] == table)]:
+                del cache[key]
+
+    def invalidate_ddl(self, sql):
+        # Schema changes sent through execute() as well as the helpers make the snapshot and column caches stale.
+        if _ddl_database.match(sql):
+            return self.invalidate_schema()
+
+        tables = referenced_tables(sql)
+        if not tables:
+            return self.invalidate_schema(database=self.db_name)
+        for table in tables:
+            self.invalidate_schema(table)
+
     #############################################
 
     def set_autocommit(self, **kwargs):
         sql = f'SET AUTOCOMMIT = {kwargs.get("autocommit", True)};'
 
         try:
-            lg.info(f'set_autocommit:{sql}')
-            return self.cursor.execute(sql)
+            lg.info('set_autocommit:%s', sql)
+            result = self._execute('set_autocommit', sql)
+            self.autocommit = bool(kwargs.get('autocommit', True))
+            return result
         except Exception as err:
             lg.error(f'set_autocommit:{str(err)}:{sql}')
 
     def get_table_status(self, table=None, **kwargs):
         database = kwargs.get('database', self.db_name)
 
-        sql = "SHOW TABLE STATUS"
+        # Always asked live, row counts, sizes and AUTO_INCREMENT change with every write.
+        sql = f"SHOW TABLE STATUS FROM `{database}`" if database else "SHOW TABLE STATUS"
         if table:
             sql += f" WHERE Name='{table}'"
 
         if database or table:
             try:
-                if database == self.db_name:
-                    self.cursor.execute(sql)
-                    rows = self.cursor.fetchall()
-                else:
-                    db = self.db_name
-                    self.use(database)
-                    self.cursor.execute(sql)
-                    rows = self.cursor.fetchall()
-                    self.use(db)
+                rows = self._fetch('get_table_status', sql)
                 if rows:
                     return rows
             except Exception as err:
                 lg.error(f'get_table_status:{str(err)}:{sql}')
+
+
+_retry_codes = (1205, 1213)
+_unknown_statement = 1243
+_disconnect_codes = (2002, 2003, 2006, 2013, 2055, 1927, 4031)
+_transient_codes = _retry_codes + _disconnect_codes + (1040, )
+
+_read = re.compile(r'\s*(SELECT|SHOW|DESCRIBE|DESC|EXPLAIN)\b', re.IGNORECASE)
+# Reads that lock rows or depend on this session's state have to stay on the primary.
+_session_read = re.compile(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bINTO\s+(@|OUTFILE|DUMPFILE)|@|'
+                           r'\b(LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|GET_LOCK|RELEASE_LOCK|IS_FREE_LOCK|IS_USED_LOCK|'
+                           r'CONNECTION_ID)\s*\(|\bSHOW\s+(SLAVE|MASTER|REPLICA|BINARY|WARNINGS|ERRORS|'
+                           r'(SESSION\s+)?(STATUS|VARIABLES)|PROCESSLIST|ENGINE)\b', re.IGNORECASE)
+_idempotent = re.compile(r'\s*(SELECT|SHOW|SET|USE|DESCRIBE|DESC|EXPLAIN|SAVEPOINT|RELEASE|'
+                         r'(CREATE|DROP)\s+(TEMPORARY\s+)?\w+\s+IF\s+(NOT\s+)?EXISTS)\b', re.IGNORECASE)
+
+# Python codec names (as codecs.lookup() spells them) -> MariaDB character sets LOAD DATA can read.
+_charsets = {
+    'utf-8': 'utf8mb4', 'utf-8-sig': 'utf8mb4', 'ascii': 'ascii', 'iso8859-1': 'latin1', 'cp1252': 'latin1',
+    'iso8859-2': 'latin2', 'iso8859-7': 'greek', 'iso8859-8': 'hebrew', 'iso8859-9': 'latin5',
+    'iso8859-13': 'latin7', 'cp1250': 'cp1250', 'cp1251': 'cp1251', 'cp1256': 'cp1256', 'cp1257': 'cp1257',
+    'cp850': 'cp850', 'cp852': 'cp852', 'cp866': 'cp866', 'koi8-r': 'koi8r', 'koi8-u': 'koi8u',
+    'mac-roman': 'macroman', 'tis-620': 'tis620', 'big5': 'big5', 'gb2312': 'gb2312', 'gbk': 'gbk',
+    'euc_jp': 'ujis', 'shift_jis': 'sjis', 'cp932': 'cp932', 'euc_kr': 'euckr',
+}
+
+_earth_radius = 6371.0088
+
+
+def bounding_box(lat, lon, radius):
+    delta = radius / (_earth_radius * 0.017453292519943295)
+    south, north = max(-90.0, lat - delta), min(90.0, lat + delta)
+    if south == -90.0 or north == 90.0 or cos(radians(lat)) < 1e-9:
+        return south, -180.0, north, 180.0
+
+    delta = delta / cos(radians(lat))
+    if delta >= 180.0:
+        return south, -180.0, north, 180.0
+
+    west, east = lon - delta, lon + delta
+    west = west + 360.0 if west < -180.0 else west
+    east = east - 360.0 if east > 180.0 else east
+    return south, west, north, east
+
+
+def bbox_condition(latitude, longitude, south, west, north, east):
+    if west > east:
+        # The box crosses the antimeridian.
+        return f'{latitude} BETWEEN %s AND %s AND ({longitude} >= %s OR {longitude} <= %s)', (south, north, west, east)
+    return f'{latitude} BETWEEN %s AND %s AND {longitude} BETWEEN %s AND %s', (south, north, west, east)
+
+
+def haversine_sql(latitude, longitude):
+    return f'{_earth_radius} * 2 * ASIN(SQRT(POW(SIN(RADIANS({latitude} - %s) / 2), 2) + ' \
+           f'COS(RADIANS(%s)) * COS(RADIANS({latitude})) * POW(SIN(RADIANS({longitude} - %s) / 2), 2)))'
+
+
+_foreign_key = re.compile(r'(?:CONSTRAINT\s+\w+\s+)?FOREIGN\s+KEY\s*(?:\w+\s*)?\(([^)]*)\)\s*'
+                          r'REFERENCES\s+`?(\w+)`?\s*\(([^)]*)\)', re.IGNORECASE)
+_unique_key = re.compile(r'(?:CONSTRAINT\s+\w+\s+)?UNIQUE(?:\s+(?:KEY|INDEX))?\s*(?:\w+\s*)?\(([^)]*)\)',
+                         re.IGNORECASE)
+_index_key = re.compile(r'(?:FULLTEXT\s+|SPATIAL\s+)?(?:INDEX|KEY)\b', re.IGNORECASE)
+_inline_unique = re.compile(r'\s+UNIQUE(?:\s+KEY)?\b', re.IGNORECASE)
+
+
+def split_definitions(sql):
+    definitions = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(sql):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and not depth:
+            definitions.append(sql[start:i].strip())
+            start = i + 1
+    definitions.append(sql[start:].strip())
+    return [definition for definition in definitions if definition]
+
+
+def split_columns(columns):
+    return tuple(column.strip().strip('`').split('(')[0].strip() for column in columns.split(','))
+
+
+def split_table_sql(sql):
+    # Keeps the columns and the primary key, everything InnoDB would maintain row by row during a load
+    # (secondary indexes, UNIQUE constraints and foreign keys) is returned separately.
+    base = []
+    deferred = []
+    for definition in split_definitions(sql):
+        match = _foreign_key.match(definition)
+        if match:
+            deferred.append({'kind': 'foreign', 'definition': definition, 'columns': split_columns(match.group(1)),
+                             'references': match.group(2), 'ref_columns': split_columns(match.group(3))})
+            continue
+
+        match = _unique_key.match(definition)
+        if match:
+            deferred.append({'kind': 'unique', 'definition': definition, 'columns': split_columns(match.group(1))})
+            continue
+
+        if _index_key.match(definition):
+            deferred.append({'kind': 'index', 'definition': definition})
+            continue
+
+        if not definition.upper().startswith(('PRIMARY', 'CONSTRAINT', 'CHECK')) and _inline_unique.search(definition):
+            column = definition.split()[0].strip('`')
+            base.append(_inline_unique.sub('', definition))
+            deferred.append({'kind': 'unique', 'definition': f'UNIQUE ({column})', 'columns': (column, )})
+            continue
+
+        base.append(definition)
+
+    return ', '.join(base), deferred
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def error_code(err):
+    args = getattr(err, 'args', None)
+    if args and isinstance(args[0], int):
+        return args[0]
+
+
+def is_disconnect(err):
+    from pymysql.err import InterfaceError
+
+    return isinstance(err, InterfaceError) or error_code(err) in _disconnect_codes
+
+
+def is_transient(err):
+    from pymysql.err import InterfaceError
+
+    return isinstance(err, InterfaceError) or error_code(err) in _transient_codes
+
+
+def has_bom(path):
+    with open(path, 'rb') as f:
+        return f.read(3) == codecs.BOM_UTF8
+
+
+def transcode(path, encoding):
+    from tempfile import NamedTemporaryFile
+    from decode import Decoder
+
+    with NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.csv', delete=False) as f:
+        try:
+            for text in Decoder(path, encoding, strict=True).blocks():
+                f.write(text)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name
+
+
+def is_unavailable(err):
+    return isinstance(err, (CircuitOpenError, ConnectionError)) or is_transient(err)
+
+
+def is_read(sql):
+    return bool(_read.match(sql)) and not _session_read.search(sql)
+
+
+def is_idempotent(sql):
+    return bool(_idempotent.match(sql)) and 'FOR UPDATE' not in sql.upper()
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self.probed = 0
+        self.trips = 0
+        self.lock = Lock()
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+
+        with self.lock:
+            now = time.time()
+            if self.state == 'open':
+                if now - self.opened < self.reset_timeout:
+                    return False
+                self.state = 'half_open'
+            elif self.state == 'half_open' and now - self.probed < self.reset_timeout:
+                # One probe at a time, its outcome decides whether the circuit closes again. A probe that never
+                # reported back is replaced after reset_timeout.
+                return False
+            self.probed = now
+            return True
+
+    def success(self):
+        if self.state != 'closed' or self.failures:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                self.trips += 1
+                lg.error(f'circuit:Open after {self.failures} consecutive failure(s)')
+            self.state = 'open'
+            self.opened = time.time()
+
+    def get_state(self):
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips,
+                'retry_in': max(0.0, self.reset_timeout - (time.time() - self.opened)) if self.state == 'open' else 0.0}
+
+
+_write = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|TRUNCATE|ALTER|DROP|CREATE|RENAME|LOAD)\b', re.IGNORECASE)
+# INTO TABLE is LOAD DATA's spelling, TABLE alone would take the keyword itself for the table name.
+_tables = re.compile(r'\b(?:FROM|JOIN|INTO(?:\s+TABLE)?|UPDATE|TABLE(?:\s+IF(?:\s+NOT)?\s+EXISTS)?|EXISTS)\s+'
+                     r'((?:`?\w+`?\.)?`?\w+`?(?:\s*,\s*(?:`?\w+`?\.)?`?\w+`?)*)', re.IGNORECASE)
+_spaces = re.compile(r'\s+')
+# Temporary tables never show up in information_schema, so they leave the catalog alone.
+_ddl = re.compile(r'\s*(CREATE|ALTER|DROP|RENAME)\s+(?!TEMPORARY\b)', re.IGNORECASE)
+_ddl_database = re.compile(r'\s*(CREATE|DROP)\s+(DATABASE|SCHEMA)\b', re.IGNORECASE)
+
+
+def referenced_tables(sql):
+    tables = set()
+    for match in _tables.finditer(sql):
+        for name in match.group(1).split(','):
+            tables.add(name.strip().replace('`', '').split('.')[-1].lower())
+    return tables
+
+
+class QueryCache:
+    def __init__(self, **kwargs):
+        self.max_bytes = kwargs.get('max_bytes', 64 * 1024 * 1024)
+        self.ttl = kwargs.get('ttl', 60)
+        self.entries = OrderedDict()
+        self.tables = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(database, sql, args):
+        if args is not None and not isinstance(args, (tuple, dict)):
+            args = tuple(args)
+        if isinstance(args, dict):
+            args = tuple(sorted(args.items()))
+        return database, _spaces.sub(' ', sql).strip().rstrip(';'), args
+
+    @staticmethod
+    def sizeof(rows):
+        return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in rows)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return
+        if entry[1] < time.time():
+            self.expirations += 1
+            self.misses += 1
+            self.remove(key)
+            return
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, sql, rows, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl:
+            return
+
+        size = self.sizeof(rows)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.remove(key)
+
+        # SHOW statements and unparseable queries depend on the schema as a whole.
+        tables = referenced_tables(sql) or {'*'}
+        if sql.lstrip()[:4].upper() == 'SHOW':
+            tables.add('*')
+
+        self.entries[key] = (rows, time.time() + ttl, size, tables)
+        self.size += size
+        for table in tables:
+            self.tables.setdefault(table, set()).add(key)
+
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        rows, expires, size, tables = self.entries.pop(key)
+        self.size -= size
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def invalidate(self, tables=None):
+        if tables is None:
+            count = len(self.entries)
+            self.entries.clear()
+            self.tables.clear()
+            self.size = 0
+        else:
+            keys = set(self.tables.get('*', ()))
+            for table in tables:
+                keys.update(self.tables.get(table, ()))
+            count = len(keys)
+            for key in keys:
+                self.remove(key)
+        self.invalidations += count
+
+    def invalidate_sql(self, sql):
+        if not self.entries or not _write.match(sql):
+            return
+
+        tables = referenced_tables(sql)
+        if not tables:
+            self.invalidate()
+        else:
+            self.invalidate(tables)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+
+# pymysql FIELD_TYPE codes that map onto fixed-width NumPy dtypes, everything else is kept as text/objects.
+_numpy_types = {
+    0: 'float64', 1: 'int64', 2: 'int64', 3: 'int64', 4: 'float64', 5: 'float64',
+    8: 'int64', 9: 'int64', 13: 'int64', 246: 'float64',
+}
+
+
+class Categorical:
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def decode(self):
+        values = self.categories[self.codes]
+        values[self.codes < 0] = None
+        return values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        return f'Categorical({len(self.codes)} values, {len(self.categories)} categories)'
+
+
+class ColumnBuffer:
+    def __init__(self, np, dtype, capacity, max_categories):
+        self.np = np
+        self.dtype = dtype
+        self.max_categories = max_categories
+        self.mask = np.zeros(capacity, dtype=bool)
+        self.lookup = None
+
+        if dtype:
+            self.values = np.empty(capacity, dtype=dtype)
+        else:
+            self.lookup = {}
+            self.values = np.empty(capacity, dtype='int32')
+
+    def grow(self, size):
+        capacity = len(self.values)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+
+        # np.resize would fill the new space by repeating the old contents, the mask has to start out clear.
+        values = self.np.empty(capacity, dtype=self.values.dtype)
+        values[:len(self.values)] = self.values
+        mask = self.np.zeros(capacity, dtype=bool)
+        mask[:len(self.mask)] = self.mask
+        self.values = values
+        self.mask = mask
+
+    def extend(self, values, offset):
+        end = offset + len(values)
+        self.grow(end)
+
+        if self.lookup is not None:
+            lookup = self.lookup
+            self.values[offset:end] = [-1 if v is None else lookup.setdefault(v, len(lookup)) for v in values]
+            if len(lookup) > self.max_categories:
+                self.to_objects(end)
+            return
+
+        if None in values:
+            self.mask[offset:end] = [v is None for v in values]
+            if self.dtype == object:
+                self.values[offset:end] = values
+            else:
+                self.values[offset:end] = [0 if v is None else v for v in values]
+        else:
+            self.values[offset:end] = values
+
+    def to_objects(self, count):
+        # Too many distinct values for dictionary encoding to pay off, fall back to a plain object array.
+        categories = self.np.array(list(self.lookup), dtype=object)
+        codes = self.values[:count]
+        values = self.np.empty(len(self.values), dtype=object)
+        values[:count] = categories[codes]
+        values[:count][codes < 0] = None
+        self.mask[:count] = codes < 0
+        self.values = values
+        self.dtype = object
+        self.lookup = None
+
+    def finish(self, count):
+        if self.lookup is not None:
+            return Categorical(self.values[:count].copy(), self.np.array(list(self.lookup), dtype=object))
+
+        values = self.values[:count].copy()
+        mask = self.mask[:count]
+        if mask.any():
+            return self.np.ma.MaskedArray(values, mask=mask.copy())
+        return values
+
+
+class Catalog:
+    def __init__(self, database, fields, columns, statistics, status):
+        self.database = database
+        self.fields = fields
+        self.created = time.time()
+
+        table_field = fields.index('TABLE_NAME')
+        self.column_field = fields.index('COLUMN_NAME')
+        self.type_field = fields.index('DATA_TYPE')
+        self.position_field = fields.index('ORDINAL_POSITION')
+
+        self.columns = {}
+        self.column_index = {}
+        for row in columns:
+            self.columns.setdefault(row[table_field], []).append(row)
+            self.column_index[(row[table_field], row[self.column_field])] = row
+
+        self.indexes = {}
+        for table, index, non_unique, _, column in statistics:
+            entry = self.indexes.setdefault((table, index), {'unique': not int(non_unique), 'columns': []})
+            entry['columns'].append(column)
+
+        self.status = OrderedDict((row[0], row) for row in status)
+
+    def table_exist(self, table):
+        if table in self.status:
+            return table,
+
+    def index_exist(self, table, index):
+        if (table, index) in self.indexes:
+            return 1,
+
+    def get_column(self, table, column):
+        row = self.column_index.get((table, column))
+        if row:
+            return row,
+
+    def get_columns(self, table):
+        rows = self.columns.get(table)
+        if rows:
+            return tuple(rows)
+
+    def get_schema(self, table):
+        rows = self.columns.get(table)
+        if rows:
+            return {
+                'names': tuple(row[self.column_field] for row in rows),
+                'types': tuple(row[self.type_field] for row in rows),
+                'positions': tuple(row[self.position_field] for row in rows),
+            }
+
+
+class StatementCache:
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.statements = OrderedDict()
+        self.thread_id = None
+        self.sequence = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prepares = 0
+
+    def reset(self, thread_id=None):
+        self.statements.clear()
+        self.thread_id = thread_id
+
+    def next_name(self):
+        self.sequence += 1
+        return f'stmt_{self.sequence}'
+
+    def get(self, sql):
+        name = self.statements.get(sql)
+        if name:
+            self.hits += 1
+            self.statements.move_to_end(sql)
+        else:
+            self.misses += 1
+        return name
+
+    def put(self, sql, name):
+        self.prepares += 1
+        self.statements[sql] = name
+
+        evicted = []
+        while len(self.statements) > self.max_size:
+            evicted.append(self.statements.popitem(last=False)[1])
+            self.evictions += 1
+        return evicted
+
+    def clear(self):
+        names = list(self.statements.values())
+        self.statements.clear()
+        return names
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.statements),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'prepares': self.prepares,
+            'evictions': self.evictions,
+        }
+
+
+class BulkLoad:
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.ignore = kwargs.get('ignore', False)
+        self.verify = kwargs.get('verify', True)
+
+        self.tables = OrderedDict()
+        self.results = {}
+
+    def create_table(self, table, sql, **kwargs):
+        base, deferred = split_table_sql(sql)
+        self.tables[table] = deferred
+        return self.db.create_table(table, base, **kwargs)
+
+    def finish(self, table):
+        if table not in self.tables:
+            return self.results.get(table)
+
+        deferred = self.tables.pop(table)
+        result = {'table': table, 'definitions': len(deferred), 'seconds': 0, 'orphans': 0, 'duplicates': 0}
+        start = time.time()
+
+        if deferred:
+            # IGNORE drops rows that break a UNIQUE constraint, the same rows INSERT IGNORE would have skipped.
+            ignore = ' IGNORE' if self.ignore and any(item['kind'] == 'unique' for item in deferred) else ''
+            sql = f"ALTER{ignore} TABLE {table} {', '.join('ADD ' + item['definition'] for item in deferred)};"
+            if self.db.execute(sql) is None:
+                raise RuntimeError(f'bulk_load:Could not add indexes and constraints to {table}')
+
+        if self.verify:
+            self.check(table, deferred, result)
+
+        result['seconds'] = round(time.time() - start, 3)
+        result['valid'] = not result['orphans'] and not result['duplicates']
+        lg.info(f'bulk_load:{result}')
+        self.results[table] = result
+        return result
+
+    def finish_all(self):
+        for table in list(self.tables):
+            self.finish(table)
+        return self.results
+
+    def count(self, sql):
+        rows = self.db.query(sql)
+        if rows is None:
+            raise RuntimeError(f'bulk_load:Verification failed: {sql}')
+        return rows[0][0]
+
+    def check(self, table, deferred, result):
+        for item in deferred:
+            if item['kind'] == 'foreign':
+                join = ' AND '.join(f'c.{column}=p.{ref}' for column, ref in zip(item['columns'], item['ref_columns']))
+                present = ' AND '.join(f'c.{column} IS NOT NULL' for column in item['columns'])
+                sql = f"SELECT COUNT(*) FROM {table} c LEFT JOIN {item['references']} p ON {join} " \
+                      f"WHERE {present} AND p.{item['ref_columns'][0]} IS NULL;"
+                count = self.count(sql)
+                if count:
+                    lg.error(f"bulk_load:{table}:{count} rows violate {item['definition']}")
+                result['orphans'] += count
+
+            elif item['kind'] == 'unique':
+                columns = ', '.join(item['columns'])
+                sql = f'SELECT COUNT(*) FROM (SELECT 1 FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1) d;'
+                count = self.count(sql)
+                if count:
+                    lg.error(f"bulk_load:{table}:{count} duplicate keys for {item['definition']}")
+                result['duplicates'] += count
+
+
+class ReplicaSet:
+    def __init__(self, database, replicas, **kwargs):
+        self.policy = kwargs.get('policy', 'round_robin')
+        self.max_lag = kwargs.get('max_lag', 30)
+        self.check_interval = kwargs.get('check_interval', 5)
+        self.eject_time = kwargs.get('eject_time', 30)
+
+        self.lock = Lock()
+        self.next = 0
+        self.checked = 0
+        self.latency = {}
+        self.reads = {}
+        self.ejected = {}
+        self.replicas = []
+
+        for info in replicas:
+            # Few reconnect attempts, a dead replica should fail over to the primary quickly, not block the read.
+            replica = MariaDB(reconnect_retries=kwargs.get('replica_reconnect_retries', 1),
+                              circuit_threshold=kwargs.get('replica_circuit_threshold', 3),
+                              instrument=kwargs.get('instrument'))
+            if not replica.connect(database, connection=info, create_database=False, lazy=kwargs.get('lazy')):
+                self.eject(replica, f"Could not connect to {info['host']}:{info['port']}")
+            self.replicas.append(replica)
+
+    def name(self, replica):
+        return f'{replica.host}:{replica.port}'
+
+    def eject(self, replica, reason):
+        with self.lock:
+            self.ejected[replica] = time.time() + self.eject_time
+        lg.warning('replica:%s:Ejected for %ss:%s', self.name(replica), self.eject_time, reason)
+
+    def record(self, replica, seconds):
+        with self.lock:
+            latency = self.latency.get(replica)
+            self.latency[replica] = seconds if latency is None else latency * 0.8 + seconds * 0.2
+            self.reads[replica] = self.reads.get(replica, 0) + 1
+
+    def check(self):
+        for replica in self.replicas:
+            try:
+                if replica.conn is None and not replica.establish(replica.db_name, create=False):
+                    self.eject(replica, 'Not connected')
+                    continue
+
+                replica._execute('check', 'SHOW SLAVE STATUS;')
+                row = replica.cursor.fetchone()
+            except Exception as err:
+                if is_unavailable(err):
+                    self.eject(replica, err)
+                else:
+                    # E.g. no REPLICATION CLIENT privilege (1227), the lag is unknown but the replica still answers.
+                    lg.warning('replica:%s:Lag check failed:%s', self.name(replica), err)
+                continue
+
+            if row:
+                fields = [column[0] for column in replica.cursor.description]
+                lag = row[fields.index('Seconds_Behind_Master')]
+                if lag is None:
+                    self.eject(replica, 'Replication is not running')
+                elif lag > self.max_lag:
+                    self.eject(replica, f'Lagging {lag}s behind the primary')
+
+    def healthy(self):
+        now = time.time()
+        if now - self.checked >= self.check_interval:
+            self.checked = now
+            self.check()
+
+        with self.lock:
+            return [replica for replica in self.replicas if self.ejected.get(replica, 0) <= now]
+
+    def choose(self):
+        candidates = self.healthy()
+        if not candidates:
+            return
+
+        if callable(self.policy):
+            return self.policy(candidates, self)
+
+        if self.policy == 'least_latency':
+            # Unmeasured replicas count as fastest, so every replica gets sampled.
+            return min(candidates, key=lambda replica: self.latency.get(replica, 0))
+
+        with self.lock:
+            self.next += 1
+            return candidates[self.next % len(candidates)]
+
+    def get_stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                self.name(replica): {
+                    'reads': self.reads.get(replica, 0),
+                    'latency_seconds': round(self.latency.get(replica, 0), 6),
+                    'ejected': self.ejected.get(replica, 0) > now,
+                } for replica in self.replicas
+            }
+
+    def close(self):
+        for replica in self.replicas:
+            if replica.conn is not None:
+                replica.connection_close()
+
+
+class Lookup:
+    def __init__(self, db, table, key_columns, value_column='id', **kwargs):
+        self.db = db
+        self.table = table
+        self.key_columns = (key_columns, ) if isinstance(key_columns, str) else tuple(key_columns)
+        self.value_column = value_column
+        self.max_size = kwargs.get('max_size')
+        self.fallback = kwargs.get('fallback', True)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if kwargs.get('preload', True):
+            self.load()
+
+    def _key(self, key):
+        if len(self.key_columns) == 1 and not isinstance(key, tuple):
+            return key,
+        return tuple(key)
+
+    def load(self):
+        sql = f"SELECT {', '.join(self.key_columns)}, {self.value_column} FROM {self.table}"
+        if self.max_size:
+            sql += f' LIMIT {int(self.max_size)}'
+
+        self.cache.clear()
+        count = len(self.key_columns)
+        try:
+            for row in self.db.iter_query(sql + ';'):
+                self.cache[tuple(row[:count])] = row[count]
+        except Exception:
+            self.cache.clear()
+            if not self.fallback:
+                raise
+            # Every get() falls back to a query, so a failed preload only costs speed.
+            lg.warning(f'lookup:Preload of {self.table} failed, falling back to queries')
+            return False
+        lg.info(f'lookup:Loaded {len(self.cache)} keys from {self.table}')
+        return True
+
+    def get(self, key, default=None):
+        key = self._key(key)
+        if key in self.cache:
+            self.hits += 1
+            if self.max_size:
+                self.cache.move_to_end(key)
+            value = self.cache[key]
+            return default if value is None else value
+
+        self.misses += 1
+        if not self.fallback:
+            return default
+
+        sql = f"SELECT {self.value_column} FROM {self.table} " \
+              f"WHERE {' AND '.join(f'{name}=%s' for name in self.key_columns)} LIMIT 1;"
+        value = None
+        if self.db.execute(sql, key):
+            value = self.db.fetchone()[0]
+        self.put(key, value)
+        return default if value is None else value
+
+    def put(self, key, value):
+        key = self._key(key)
+        self.cache[key] = value
+        if self.max_size:
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class MariaDBPool:
+    def __init__(self, database=None, **kwargs):
+        self.database = database
+        self.info = kwargs.get('connection')
+        self.min_size = kwargs.get('min_size', 1)
+        self.max_size = kwargs.get('max_size', 10)
+        self.timeout = kwargs.get('timeout', 30)
+        self.idle_timeout = kwargs.get('idle_timeout', 300)
+        self.max_lifetime = kwargs.get('max_lifetime', 3600)
+        self.db_kwargs = kwargs.get('db_kwargs', {})
+
+        self.idle = []
+        self.in_use = set()
+        self.created = {}
+        self.pending = 0
+        self.closed = False
+        self.lock = Condition()
+        self.stats = {
+            'created': 0, 'closed': 0, 'checkouts': 0, 'timeouts': 0, 'failed_checks': 0,
+            'wait_time': 0.0, 'max_wait_time': 0.0,
+        }
+
+        for _ in range(self.min_size):
+            db = self._create()
+            if db:
+                self._register(db)
+                self.idle.append((db, time.time()))
+
+    def _create(self):
+        db = MariaDB(**self.db_kwargs)
+        if db.connect(self.database, connection=self.info):
+            lg.info(f'pool:Connection created ({self.size() + 1}/{self.max_size})')
+            return db
+        lg.error('pool:Could not create connection')
+
+    def _register(self, db):
+        self.created[id(db)] = time.time()
+        self.stats['created'] += 1
+
+    def _retire(self, db):
+        # Bookkeeping only, called under the lock; the caller closes the connection once the lock is released.
+        self.created.pop(id(db), None)
+        self.stats['closed'] += 1
+
+    def _healthy(self, db, last_used):
+        now = time.time()
+        if now - self.created.get(id(db), now) > self.max_lifetime:
+            return False
+        if now - last_used > self.idle_timeout:
+            return False
+        try:
+            db.conn.ping(False)
+            return True
+        except Exception as err:
+            self.stats['failed_checks'] += 1
+            lg.warning(f'pool:Health check failed:{str(err)}')
+
+        # reconnect() restores the database, autocommit and session variables, a bare ping(True) would not.
+        try:
+            return db.reconnect()
+        except Exception as err:
+            lg.error(f'pool:Reconnect failed:{str(err)}')
+
+    def size(self):
+        return len(self.idle) + len(self.in_use) + self.pending
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.time()
+        deadline = start + timeout
+
+        while True:
+            db = last_used = None
+            with self.lock:
+                while True:
+                    if self.closed:
+                        raise RuntimeError('pool:Pool is closed')
+                    if self.idle:
+                        db, last_used = self.idle.pop()
+                        break
+                    if self.size() < self.max_size:
+                        self.pending += 1
+                        break
+
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise TimeoutError(f'pool:No connection available after {timeout} seconds')
+                    self.lock.wait(remaining)
+
+            # Connecting and pinging happen outside the lock so other threads are not blocked on network I/O.
+            if db:
+                if not self._healthy(db, last_used):
+                    with self.lock:
+                        self._retire(db)
+                        self.lock.notify()
+                    db.connection_close()
+                    continue
+            else:
+                db = self._create()
+                with self.lock:
+                    self.pending -= 1
+                    if not db:
+                        self.lock.notify()
+                        raise ConnectionError('pool:Could not create connection')
+                    self._register(db)
+
+            with self.lock:
+                self.in_use.add(db)
+                wait = time.time() - start
+                self.stats['checkouts'] += 1
+                self.stats['wait_time'] += wait
+                self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait)
+            return db
+
+    def release(self, db):
+        with self.lock:
+            self.in_use.discard(db)
+            closed = self.closed
+            if closed:
+                self._retire(db)
+            else:
+                self.idle.append((db, time.time()))
+            self.lock.notify()
+        if closed:
+            db.connection_close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        db = self.acquire(timeout)
+        try:
+            yield db
+        except Exception:
+            try:
+                db.conn.rollback()
+            except Exception as err:
+                lg.error(f'pool:{str(err)}')
+            raise
+        finally:
+            self.release(db)
+
+    def prune(self):
+        retired = []
+        with self.lock:
+            now = time.time()
+            keep = []
+            for db, last_used in self.idle:
+                expired = now - self.created.get(id(db), now) > self.max_lifetime
+                if expired or (now - last_used > self.idle_timeout and len(keep) + len(self.in_use) >= self.min_size):
+                    self._retire(db)
+                    retired.append(db)
+                else:
+                    keep.append((db, last_used))
+            self.idle = keep
+        for db in retired:
+            db.connection_close()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['in_use'] = len(self.in_use)
+            stats['idle'] = len(self.idle)
+            stats['size'] = self.size()
+            stats['avg_wait_time'] = stats['wait_time'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            return stats
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            retired = [db for db, _ in self.idle]
+            for db in retired:
+                self._retire(db)
+            self.idle = []
+            self.lock.notify_all()
+        for db in retired:
+            db.connection_close()
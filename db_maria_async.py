@@ -0,0 +1,326 @@
+########################################################################################################################
+#    File: db_maria_async.py
+# Purpose: asyncio version of the MariaDB class, backed by an aiomysql connection pool.
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import logging as lg
+
+from weakref import WeakKeyDictionary
+from contextlib import asynccontextmanager
+
+version = '0.1'
+
+
+class AsyncSession:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = None
+
+    async def execute(self, sql, args=None):
+        try:
+            lg.info('execute:%s', sql)
+            if not self.cursor:
+                self.cursor = await self.conn.cursor()
+            return await self.cursor.execute(sql, args)
+        except Exception as err:
+            lg.error(f'execute:{str(err)}:{sql}')
+
+    async def mogrify(self, sql, args=None):
+        if not self.cursor:
+            self.cursor = await self.conn.cursor()
+        return self.cursor.mogrify(sql, args)
+
+    async def fetchone(self):
+        return await self.cursor.fetchone()
+
+    async def fetchall(self):
+        return await self.cursor.fetchall()
+
+    async def commit(self):
+        try:
+            await self.conn.commit()
+            lg.info('commit')
+            return True
+        except Exception as err:
+            lg.error(f'commit:{str(err)}')
+
+    async def rollback(self):
+        try:
+            await self.conn.rollback()
+            lg.info('rollback')
+            return True
+        except Exception as err:
+            lg.error(f'rollback:{str(err)}')
+
+    async def close(self):
+        if self.cursor:
+            await self.cursor.close()
+            self.cursor = None
+
+
+class AsyncMariaDB:
+    def __init__(self, **kwargs):
+        self.host = None
+        self.port = None
+        self.pool = None
+        self.db_name = None
+        self.db_user = None
+        self.db_password = None
+        self.charset = None
+        self.schema = {}
+        self.sql_cache = {}
+        self.max_allowed_packet = None
+        self.selected = WeakKeyDictionary()
+        self.min_size = kwargs.get('min_size', 1)
+        self.max_size = kwargs.get('max_size', 10)
+
+    async def connect(self, database=None, **kwargs):
+        import aiomysql
+
+        info = kwargs.get('connection')
+        if not info:
+            return
+
+        self.host = info['host']
+        self.port = info['port']
+        self.db_user = info['user']
+        self.db_password = info['password']
+        self.charset = info.get('charset', 'utf8mb4')
+
+        database = kwargs.get('database', database)
+
+        try:
+            self.pool = await aiomysql.create_pool(
+                host=self.host, port=self.port, user=self.db_user, password=self.db_password,
+                charset=self.charset, autocommit=kwargs.get('autocommit', True),
+                minsize=self.min_size, maxsize=self.max_size)
+
+            if database:
+                if not await self.database_exist(database):
+                    await self.create_database(database)
+                await self.use(database)
+
+            lg.info(f'connect:Connection pool created:('
+                    f'host={self.host}, '
+                    f'port={self.port}, '
+                    f'user={self.db_user}, '
+                    f'database={database} '
+                    f'charset={self.charset})')
+            return True
+        except Exception as err:
+            lg.error(f'connect:{str(err)}')
+
+    async def close(self):
+        if self.pool:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+            lg.info(f'close:Closed database ({self.db_name})')
+            self.db_name = None
+
+    async def use(self, database, **kwargs):
+        database = kwargs.get('database', database)
+
+        async with self.session(database) as session:
+            if await session.execute(f'USE {database}') is not None:
+                self.invalidate_schema()
+                self.db_name = database
+                lg.info(f'use:USE {database}')
+                return True
+
+    @asynccontextmanager
+    async def session(self, database=None):
+        database = database or self.db_name
+        conn = await self.pool.acquire()
+        session = AsyncSession(conn)
+        try:
+            # Pooled connections keep the last database selected on them, conn.db only reflects the one the
+            # connection was opened with, so the selection is tracked here per connection.
+            if database and self.selected.get(conn, conn.db) != database:
+                await conn.select_db(database)
+                self.selected[conn] = database
+            yield session
+        finally:
+            await session.close()
+            self.pool.release(conn)
+
+    async def execute(self, sql, args=None):
+        async with self.session() as session:
+            return await session.execute(sql, args)
+
+    async def fetchone(self, sql, args=None):
+        async with self.session() as session:
+            if await session.execute(sql, args):
+                return await session.fetchone()
+
+    async def fetchall(self, sql, args=None):
+        async with self.session() as session:
+            if await session.execute(sql, args):
+                return await session.fetchall()
+
+    async def drop_table(self, table):
+        self.invalidate_schema(table)
+        return await self.execute(f'DROP TABLE {table}')
+
+    async def drop_index(self, table, index):
+        self.invalidate_schema(table)
+        return await self.execute(f'DROP INDEX {index} ON {table};')
+
+    async def drop_database(self, database, **kwargs):
+        database = kwargs.get('database', database)
+        self.invalidate_schema(database=database)
+        return await self.execute(f'DROP DATABASE {database};')
+
+    async def create_table(self, table, sql, **kwargs):
+        database_engine = kwargs.get('database_engine', 'InnoDB')
+        self.invalidate_schema(table)
+        return await self.execute(f'CREATE TABLE {table} ({sql}) ENGINE={database_engine}')
+
+    async def create_index(self, table, column, index):
+        self.invalidate_schema(table)
+        return await self.execute(f'CREATE INDEX {index} ON {table}({column});')
+
+    async def create_database(self, database, **kwargs):
+        database = kwargs.get('database', database)
+        return await self.execute(f'CREATE DATABASE {database};')
+
+    async def row_exist(self, table, _id):
+        return await self.fetchone(f'SELECT id FROM {table} WHERE id=%s;', (_id,))
+
+    async def table_exist(self, table, **kwargs):
+        database = kwargs.get('database', self.db_name)
+        sql = 'SELECT table_name FROM information_schema.tables WHERE table_schema=%s AND table_name=%s;'
+        return await self.fetchone(sql, (database, table))
+
+    async def index_exist(self, table, index, **kwargs):
+        database = kwargs.get('database', self.db_name)
+        sql = 'SELECT 1 FROM information_schema.statistics WHERE table_schema=%s AND table_name=%s AND index_name=%s;'
+        return await self.fetchone(sql, (database, table, index)) or False
+
+    async def database_exist(self, database, **kwargs):
+        database = kwargs.get('database', database)
+        rows = await self.fetchall('SHOW DATABASES;')
+        if rows:
+            return any(database in row for row in rows) or None
+
+    async def get_databases(self):
+        rows = await self.fetchall('SHOW DATABASES;')
+        if rows:
+            return tuple([i[0] for i in rows])
+
+    async def get_tables(self, **kwargs):
+        database = kwargs.get('database', self.db_name)
+        rows = await self.fetchall(f'SHOW TABLES FROM {database};')
+        if rows:
+            return tuple([i[0] for i in rows])
+
+    async def get_column_metadata(self, table, column, **kwargs):
+        database = kwargs.get('database', self.db_name)
+        sql = 'SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME=%s;'
+        rows = await self.fetchall(sql, (database, table, column))
+        if rows:
+            return tuple(rows)
+
+    async def get_columns_metadata(self, table, **kwargs):
+        database = kwargs.get('database', self.db_name)
+        sql = 'SELECT * FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s;'
+        rows = await self.fetchall(sql, (database, table))
+        if rows:
+            return tuple(rows)
+
+    async def get_table_status(self, table=None, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        sql = f'SHOW TABLE STATUS FROM {database}'
+        if table:
+            return await self.fetchall(sql + ' WHERE Name=%s', (table,))
+        return await self.fetchall(sql)
+
+    async def get_column_names(self, table, **kwargs):
+        database = kwargs.get('database', self.db_name)
+
+        key = (database, table)
+        if key not in self.schema:
+            sql = 'SELECT COLUMN_NAME FROM information_schema.COLUMNS ' \
+                  'WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION;'
+            rows = await self.fetchall(sql, (database, table))
+            if not rows:
+                return ()
+            self.schema[key] = tuple(row[0] for row in rows)
+        return self.schema[key]
+
+    def invalidate_schema(self, table=None, **kwargs):
+        database = kwargs.get('database', self.db_name if table else None)
+
+        if not table and not database:
+            self.schema.clear()
+            self.sql_cache.clear()
+            return
+
+        for cache in (self.schema, self.sql_cache):
+            for key in [key for key in cache if key[0] == database and (table is None or key[1] == table)]:
+                del cache[key]
+
+    async def insert_row(self, table, row):
+        key = (self.db_name, table, 'insert_row')
+        sql = self.sql_cache.get(key)
+        if not sql:
+            column_names = (await self.get_column_names(table))[1:]
+            sql = self.sql_cache[key] = \
+                f"INSERT INTO {table} ({','.join(column_names)}) VALUES ({('%s,' * len(column_names)).rstrip(',')});"
+        return await self.execute(sql, row)
+
+    async def insert_rows(self, table, rows, batch_size=1000, **kwargs):
+        mode = kwargs.get('mode')
+
+        column_names = (await self.get_column_names(table))[1:]
+        if not column_names:
+            lg.error(f'insert_rows:No columns found for table {table}')
+            return
+
+        head = f"INSERT{' IGNORE' if mode == 'ignore' else ''} INTO {table} ({','.join(column_names)}) VALUES "
+        tail = ';'
+        if mode == 'update':
+            tail = f" ON DUPLICATE KEY UPDATE {','.join(f'{name}=VALUES({name})' for name in column_names)};"
+        placeholder = f"({('%s,' * len(column_names)).rstrip(',')})"
+        max_size = await self.get_max_allowed_packet() - len(head) - len(tail) - 1024
+
+        total = 0
+        async with self.session() as session:
+            values = []
+            size = 0
+            for row in rows:
+                value = await session.mogrify(placeholder, tuple(row))
+                length = len(value.encode()) + 1
+                if values and (len(values) >= batch_size or size + length > max_size):
+                    total += await session.execute(head + ','.join(values) + tail) or 0
+                    values = []
+                    size = 0
+
+                values.append(value)
+                size += length
+
+            if values:
+                total += await session.execute(head + ','.join(values) + tail) or 0
+
+        return total
+
+    async def get_max_allowed_packet(self):
+        if not self.max_allowed_packet:
+            self.max_allowed_packet = 1024 * 1024
+            try:
+                row = await self.fetchone('SELECT @@max_allowed_packet;')
+                self.max_allowed_packet = int(row[0])
+            except Exception as err:
+                lg.error(f'get_max_allowed_packet:{str(err)}')
+
+        return self.max_allowed_packet
+
+    async def update_row(self, table, _id, *args):
+        data = args[0]
+        column_names = (await self.get_column_names(table))[1:]
+        sql = f"UPDATE {table} SET {','.join(name + '=%s' for name in column_names)} WHERE id=%s;"
+        return await self.execute(sql, list(data) + [_id])
+
+    async def delete_row(self, table, _id):
+        return await self.execute(f'DELETE FROM {table} WHERE id = %s;', (_id,))
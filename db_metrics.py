@@ -0,0 +1,157 @@
+########################################################################################################################
+#    File: db_metrics.py
+# Purpose: Query instrumentation for the MariaDB class (latency histograms, slow-query log, per-method counters).
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import re
+import json
+import logging as lg
+
+from threading import Lock
+
+version = '0.1'
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_strings = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_params = re.compile(r'%s|\?')
+_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_values = re.compile(r'(VALUES\s*\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+', re.IGNORECASE)
+_spaces = re.compile(r'\s+')
+
+
+def normalize(sql):
+    sql = _strings.sub('?', sql)
+    sql = _numbers.sub('?', sql)
+    sql = _params.sub('?', sql)
+    sql = _lists.sub('(...)', sql)
+    sql = _values.sub(r'\1', sql)
+    return _spaces.sub(' ', sql).strip().rstrip(';')
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds, rows):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+        self.count += 1
+        self.total += seconds
+        self.rows += rows if rows and rows > 0 else 0
+        self.max = max(self.max, seconds)
+        self.min = seconds if self.min is None else min(self.min, seconds)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_seconds': round(self.total, 6),
+            'mean_seconds': round(self.total / self.count, 6) if self.count else 0.0,
+            'min_seconds': round(self.min or 0.0, 6),
+            'max_seconds': round(self.max, 6),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Instrumentation:
+    def __init__(self, **kwargs):
+        self.slow_query = kwargs.get('slow_query', 1.0)
+        self.buckets = kwargs.get('buckets', BUCKETS)
+        self.max_shapes = kwargs.get('max_shapes', 1000)
+
+        self.lock = Lock()
+        self.shapes = {}
+        self.methods = {}
+        self.normalized = {}
+
+    def shape(self, sql):
+        shape = self.normalized.get(sql)
+        if shape is None:
+            shape = normalize(sql)
+            if len(self.normalized) < self.max_shapes * 10:
+                self.normalized[sql] = shape
+        return shape
+
+    def record(self, method, sql, args, seconds, rows, error=False):
+        shape = self.shape(sql)
+
+        with self.lock:
+            histogram = self.shapes.get(shape)
+            if histogram is None:
+                if len(self.shapes) >= self.max_shapes:
+                    shape = '<other>'
+                histogram = self.shapes.setdefault(shape, Histogram(self.buckets))
+            counters = self.methods.setdefault(method, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'rows': 0})
+
+            counters['calls'] += 1
+            counters['seconds'] += seconds
+            if error:
+                histogram.errors += 1
+                counters['errors'] += 1
+            else:
+                histogram.add(seconds, rows)
+                counters['rows'] += rows if rows and rows > 0 else 0
+
+        if self.slow_query is not None and seconds >= self.slow_query:
+            lg.warning('slow_query:%s:%.3fs:%s:%r', method, seconds, sql, args)
+
+    def reset(self):
+        with self.lock:
+            self.shapes.clear()
+            self.methods.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'slow_query_seconds': self.slow_query,
+                'methods': {name: dict(counters) for name, counters in self.methods.items()},
+                'statements': {shape: histogram.snapshot() for shape, histogram in self.shapes.items()},
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='mariadb'):
+        def label(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+        lines = [
+            f'# TYPE {prefix}_method_calls_total counter',
+            f'# TYPE {prefix}_method_errors_total counter',
+            f'# TYPE {prefix}_query_seconds histogram',
+            f'# TYPE {prefix}_query_rows_total counter',
+            f'# TYPE {prefix}_query_errors_total counter',
+        ]
+        snapshot = self.snapshot()
+
+        for name, counters in sorted(snapshot['methods'].items()):
+            lines.append(f'{prefix}_method_calls_total{{method="{name}"}} {counters["calls"]}')
+            lines.append(f'{prefix}_method_errors_total{{method="{name}"}} {counters["errors"]}')
+
+        for shape, stats in sorted(snapshot['statements'].items()):
+            sql = label(shape)
+            cumulative = 0
+            for bound, count in stats['buckets'].items():
+                cumulative += count
+                lines.append(f'{prefix}_query_seconds_bucket{{sql="{sql}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_query_seconds_sum{{sql="{sql}"}} {stats["total_seconds"]}')
+            lines.append(f'{prefix}_query_seconds_count{{sql="{sql}"}} {stats["count"]}')
+            lines.append(f'{prefix}_query_rows_total{{sql="{sql}"}} {stats["rows"]}')
+            lines.append(f'{prefix}_query_errors_total{{sql="{sql}"}} {stats["errors"]}')
+
+        return '\n'.join(lines) + '\n'
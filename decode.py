@@ -0,0 +1,150 @@
+########################################################################################################################
+#    File: decode.py
+# Purpose: Streaming text decoding for the CSV loaders (bounded encoding sniffing, block-wise incremental decoding).
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import codecs
+import logging as lg
+
+from pathlib import Path
+from itertools import chain
+
+version = '0.1'
+
+_boms = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+class DecodeError(ValueError):
+    def __init__(self, path, offset, encoding, reason):
+        super().__init__(f'{path}:Cannot decode byte(s) at offset {offset} as {encoding}: {reason}')
+        self.path = path
+        self.offset = offset
+        self.encoding = encoding
+        self.reason = reason
+
+
+def sniff_encoding(path, sample_size=65536, default='iso-8859-1'):
+    with open(path, 'rb') as f:
+        return sniff_bytes(f.read(sample_size), default)
+
+
+def sniff_bytes(sample, default='iso-8859-1'):
+    for bom, encoding in _boms:
+        if sample.startswith(bom):
+            return encoding
+
+    try:
+        # Not final, a multi-byte character cut off by the end of the sample is not an error.
+        codecs.getincrementaldecoder('utf-8')().decode(sample, False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    try:
+        import chardet
+    except ImportError:
+        return default
+
+    encoding = chardet.detect(sample).get('encoding')
+    try:
+        return codecs.lookup(encoding).name if encoding else default
+    except LookupError:
+        return default
+
+
+class Decoder:
+    def __init__(self, path, encoding=None, **kwargs):
+        self.path = Path(path)
+        self.block_size = kwargs.get('block_size', 1024 * 1024)
+        self.strict = kwargs.get('strict', False)
+        self.mmap = kwargs.get('mmap', False)
+        self.source = kwargs.get('blocks')
+
+        if self.source is not None:
+            # Already decompressed or downloaded blocks, e.g. a zip member, the first one doubles as the sample.
+            self.source = iter(self.source)
+            first = next(self.source, b'')
+            self.source = chain((first, ), self.source)
+            encoding = encoding or sniff_bytes(first[:kwargs.get('sample_size', 65536)])
+        self.encoding = encoding or sniff_encoding(self.path, kwargs.get('sample_size', 65536))
+
+        self.bytes_read = 0
+        self.errors = []
+
+    def read_blocks(self):
+        if self.source is not None:
+            yield from self.source
+            return
+
+        with open(self.path, 'rb') as f:
+            if self.mmap and self.path.stat().st_size:
+                import mmap
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for start in range(0, len(m), self.block_size):
+                        yield m[start:start + self.block_size]
+                return
+
+            for block in iter(lambda: f.read(self.block_size), b''):
+                yield block
+
+    def decode(self, decoder, data, offset, final=False):
+        # offset is the absolute position of data in the file, bytes the decoder still holds from the
+        # previous block sit just before it.
+        text = []
+        while True:
+            try:
+                text.append(decoder.decode(data, final))
+                return ''.join(text)
+            except UnicodeDecodeError as err:
+                pending = decoder.getstate()[0]
+                data = pending + data
+                offset -= len(pending)
+                position = offset + err.start
+                if self.strict:
+                    raise DecodeError(str(self.path), position, self.encoding, err.reason) from None
+
+                self.errors.append(position)
+                decoder.reset()
+                text.append(decoder.decode(data[:err.start], True) + '\ufffd')
+                decoder.reset()
+                data = data[err.end:]
+                offset += err.end
+
+    def blocks(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)('strict')
+        self.bytes_read = 0
+        self.errors = []
+
+        for block in self.read_blocks():
+            offset = self.bytes_read
+            self.bytes_read += len(block)
+            text = self.decode(decoder, block, offset)
+            if text:
+                yield text
+
+        text = self.decode(decoder, b'', self.bytes_read, True)
+        if text:
+            yield text
+
+        if self.errors:
+            lg.warning(f'decode:{self.path}:{len(self.errors)} undecodable byte sequence(s) replaced as '
+                       f'{self.encoding}, first at offset {self.errors[0]}')
+
+    def __iter__(self):
+        # Lines keep their terminators, so csv.reader sees exactly what open(..., newline='') would give it
+        # and quoted fields spanning lines still work.
+        rest = ''
+        for text in self.blocks():
+            lines = (rest + text).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest
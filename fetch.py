@@ -0,0 +1,342 @@
+########################################################################################################################
+#    File: fetch.py
+# Purpose: Source downloads for the loaders (conditional/resumable HTTP, streaming zip members without extracting).
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+import logging as lg
+
+from queue import Queue, Full
+from pathlib import Path
+from threading import Thread, Event
+from http.client import HTTPException
+
+from decode import Decoder
+
+version = '0.1'
+
+_local_header = b'PK\x03\x04'
+_central_header = b'PK\x01\x02'
+_end_header = b'PK\x05\x06'
+_descriptor = b'PK\x07\x08'
+
+_done = object()
+
+
+class Fetcher:
+    def __init__(self, cache_dir='.', **kwargs):
+        self.cache_dir = Path(cache_dir)
+        self.timeout = kwargs.get('timeout', 60)
+        self.block_size = kwargs.get('block_size', 256 * 1024)
+        self.retries = kwargs.get('retries', 3)
+        self.backoff = kwargs.get('backoff', 1.0)
+
+    def cache_path(self, url):
+        name = url.rstrip('/').split('/')[-1] or 'index'
+        return self.cache_dir.joinpath(f'{hashlib.md5(url.encode()).hexdigest()[:8]}_{name}')
+
+    @staticmethod
+    def meta_path(path):
+        return Path(f'{path}.meta.json')
+
+    def load_meta(self, path):
+        try:
+            with open(self.meta_path(path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_meta(self, path, url, response):
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(self.meta_path(path), 'w') as f:
+            json.dump(meta, f)
+
+    def request(self, url, headers=None):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        try:
+            return urlopen(Request(url, headers=headers or {}), timeout=self.timeout)
+        except HTTPError as err:
+            # HTTPError doubles as the response for the status codes the callers handle themselves.
+            if err.code in (304, 416):
+                return err
+            raise
+
+    def conditional_headers(self, path):
+        if not Path(path).exists():
+            return {}
+
+        meta = self.load_meta(path)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def get(self, url, path=None):
+        path = Path(path or self.cache_path(url))
+        with self.request(url, self.conditional_headers(path)) as response:
+            if response.code == 304:
+                lg.info(f'fetch:{url}:Not modified, using {path}')
+                return path.read_bytes()
+            data = response.read()
+
+        part = Path(f'{path}.part')
+        part.write_bytes(data)
+        os.replace(part, path)
+        self.save_meta(path, url, response)
+        lg.info(f'fetch:{url}:{len(data)} bytes')
+        return data
+
+    def open(self, url, path=None):
+        path = Path(path or self.cache_path(url))
+        part = Path(f'{path}.part')
+
+        offset = part.stat().st_size if part.exists() else 0
+        response = self.resume(url, part, offset) if offset else self.request(url, self.conditional_headers(path))
+
+        if response.code == 304:
+            response.close()
+            lg.info(f'fetch:{url}:Not modified, using {path}')
+            return False, self.read_file(path)
+
+        if response.code != 206:
+            offset = 0
+        self.save_meta(part, url, response)
+        return True, self.download(url, path, response, offset)
+
+    def resume(self, url, part, offset):
+        headers = {'Range': f'bytes={offset}-'}
+        meta = self.load_meta(part)
+        validator = meta.get('etag') or meta.get('last_modified')
+        if validator:
+            # If the file changed since the partial download the server answers 200 with the whole new file.
+            headers['If-Range'] = validator
+
+        response = self.request(url, headers)
+        if response.code == 416:
+            response.close()
+            part.unlink()
+            response = self.request(url)
+        lg.info(f'fetch:{url}:Resuming at byte {offset} (HTTP {response.code})')
+        return response
+
+    def read_file(self, path, offset=0, end=None):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = end - offset if end is not None else None
+            while remaining is None or remaining > 0:
+                block = f.read(self.block_size if remaining is None else min(self.block_size, remaining))
+                if not block:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+
+    def download(self, url, path, response, offset):
+        part = Path(f'{path}.part')
+        if offset:
+            # Bytes from an earlier attempt come first, the stream always starts at byte 0.
+            yield from self.read_file(part, 0, offset)
+
+        attempt = 0
+        while True:
+            try:
+                with response, open(part, 'ab' if offset else 'wb') as f:
+                    for block in iter(lambda: response.read(self.block_size), b''):
+                        f.write(block)
+                        offset += len(block)
+                        yield block
+                break
+            except (OSError, HTTPException) as err:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                lg.warning(f'fetch:{url}:{str(err)}:Retry {attempt}/{self.retries} from byte {offset}')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                response = self.resume(url, part, offset)
+                if response.code != 206:
+                    response.close()
+                    raise ConnectionError(f'fetch:{url}:Server cannot resume at byte {offset}')
+
+        os.replace(part, path)
+        os.replace(self.meta_path(part), self.meta_path(path))
+        lg.info(f'fetch:{url}:{offset} bytes saved to {path}')
+
+
+def prefetch(blocks, queue_size=16):
+    # Runs the producer (e.g. a download) in its own thread, so it keeps going while the consumer decompresses.
+    queue = Queue(queue_size)
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    break
+        except Exception as err:
+            put(err)
+        finally:
+            # A consumer that stops early must not leave the response and the .part file open.
+            close = getattr(blocks, 'close', None)
+            if close:
+                close()
+        put(_done)
+
+    thread = Thread(target=produce, name='fetch-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        thread.join()
+    finally:
+        stop.set()
+
+
+class BlockReader:
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.buffer = b''
+
+    def read_some(self, size):
+        if not self.buffer:
+            self.buffer = next(self.blocks, b'')
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            data = self.read_some(size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+class ZipMember:
+    def __init__(self, reader, name, flags, method, crc, compressed_size, size, block_size=256 * 1024):
+        self.reader = reader
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.crc = crc
+        self.compressed_size = compressed_size
+        self.size = size
+        self.block_size = block_size
+        self.consumed = False
+
+    def compressed(self):
+        remaining = self.compressed_size
+        while remaining > 0:
+            data = self.reader.read_some(min(self.block_size, remaining))
+            if not data:
+                raise EOFError(f'zip:{self.name}:Truncated member')
+            remaining -= len(data)
+            yield data
+
+    def chunks(self):
+        if self.consumed:
+            raise RuntimeError(f'zip:{self.name}:Member was already read')
+        self.consumed = True
+
+        described = self.flags & 0x08
+        if self.method not in (0, 8) or (described and self.method == 0):
+            raise ValueError(f'zip:{self.name}:Unsupported compression method {self.method}')
+
+        crc = 0
+        size = 0
+        if self.method == 0:
+            for data in self.compressed():
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                yield data
+        else:
+            decompressor = zlib.decompressobj(-15)
+            # Without a data descriptor the header has the compressed size, with one the deflate stream's own
+            # end marker is the only way to find where the member stops.
+            source = iter(lambda: self.reader.read_some(self.block_size), b'') if described else self.compressed()
+            for data in source:
+                data = decompressor.decompress(data)
+                if data:
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    yield data
+                if decompressor.eof:
+                    self.reader.unread(decompressor.unused_data)
+                    break
+            data = decompressor.flush()
+            if data:
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                yield data
+            if not decompressor.eof:
+                raise EOFError(f'zip:{self.name}:Truncated member')
+
+        if described:
+            descriptor = self.reader.read(4)
+            if descriptor == _descriptor:
+                descriptor = self.reader.read(4)
+            self.crc, _, self.size = struct.unpack('<III', descriptor + self.reader.read(8))
+
+        if crc != self.crc or size != self.size:
+            raise ValueError(f'zip:{self.name}:CRC or size mismatch')
+
+    def skip(self):
+        if not self.consumed:
+            for _ in self.chunks():
+                pass
+
+    def lines(self, encoding=None, **kwargs):
+        return Decoder(self.name, encoding, blocks=self.chunks(), **kwargs)
+
+
+def iter_zip(reader):
+    # Walks the local file headers front to back, so members can be read while the archive is still arriving.
+    # The central directory at the end is never needed.
+    while True:
+        signature = reader.read(4)
+        if signature in (_central_header, _end_header, b''):
+            return
+        if signature != _local_header:
+            raise ValueError(f'zip:Unexpected signature {signature!r}')
+
+        _, flags, method, _, _, crc, compressed_size, size, name_size, extra_size = \
+            struct.unpack('<HHHHHIIIHH', reader.read(26))
+        name = reader.read(name_size).decode('utf-8' if flags & 0x800 else 'cp437')
+        reader.read(extra_size)
+        if 0xFFFFFFFF in (compressed_size, size):
+            raise ValueError(f'zip:{name}:ZIP64 members are not supported')
+
+        member = ZipMember(reader, name, flags, method, crc, compressed_size, size)
+        yield member
+        member.skip()
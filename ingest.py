@@ -0,0 +1,235 @@
+########################################################################################################################
+#    File: ingest.py
+# Purpose: Parallel CSV ingestion pipeline (reader processes -> transform thread -> writer threads).
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import time
+import logging as lg
+
+from queue import Queue, Empty
+from multiprocessing import Queue as ProcessQueue
+from threading import Thread, Lock
+from concurrent.futures import ProcessPoolExecutor
+
+from decode import Decoder, DecodeError
+from db_maria import MariaDB
+
+version = '0.1'
+
+_done = object()
+_chunks = None
+
+
+def init_reader(queue):
+    global _chunks
+    _chunks = queue
+
+
+def parse_file(path, encoding=None, chunk_size=5000):
+    # Runs in a reader process, chunks go onto the shared bounded queue as they are parsed so a large file
+    # never sits in memory whole, (path, None) marks the end of the file.
+    from csv import reader, Error
+
+    path = str(path)
+    decoder = None
+    rows = 0
+    errors = []
+    try:
+        decoder = Decoder(path, encoding)
+        results = reader(decoder, delimiter=',', quotechar='"')
+        chunk = []
+        try:
+            for row in results:
+                chunk.append((results.line_num, row))
+                if len(chunk) >= chunk_size:
+                    _chunks.put((path, chunk))
+                    rows += len(chunk)
+                    chunk = []
+        except (Error, DecodeError) as err:
+            errors.append((path, results.line_num, str(err)))
+        if chunk:
+            _chunks.put((path, chunk))
+            rows += len(chunk)
+
+        for offset in decoder.errors:
+            errors.append((path, 0, f'decode:Undecodable bytes at offset {offset} replaced ({decoder.encoding})'))
+    finally:
+        _chunks.put((path, None))
+
+    return path, decoder.encoding, rows, errors
+
+
+class Counter:
+    def __init__(self):
+        self.lock = Lock()
+        self.rows_in = 0
+        self.rows_out = 0
+        self.seconds = 0.0
+        self.skipped = 0
+
+    def add(self, rows_in, rows_out, seconds, skipped=0):
+        with self.lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+            self.seconds += seconds
+            self.skipped += skipped
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'skipped': self.skipped,
+                'seconds': round(self.seconds, 3),
+                'rows_per_second': round(self.rows_out / self.seconds, 1) if self.seconds else 0.0,
+            }
+
+
+class Pipeline:
+    def __init__(self, table, transform, **kwargs):
+        self.table = table
+        self.transform = transform
+        self.database = kwargs.get('database')
+        self.info = kwargs.get('connection')
+        self.readers = kwargs.get('readers', 2)
+        self.writers = kwargs.get('writers', 2)
+        self.queue_size = kwargs.get('queue_size', 8)
+        self.chunk_size = kwargs.get('chunk_size', 5000)
+        self.batch_size = kwargs.get('batch_size', 1000)
+        self.encoding = kwargs.get('encoding')
+        self.mode = kwargs.get('mode', 'ignore')
+
+        self.counters = {'read': Counter(), 'transform': Counter(), 'write': Counter()}
+        self.errors = []
+        self.errors_lock = Lock()
+
+    def error(self, file, line, message):
+        with self.errors_lock:
+            self.errors.append((file, line, message))
+        lg.error(f'ingest:{file}:{line}:{message}')
+
+    def read(self, files, read_queue):
+        start = time.time()
+        chunks = ProcessQueue(self.queue_size)
+        try:
+            with ProcessPoolExecutor(max_workers=self.readers, initializer=init_reader,
+                                     initargs=(chunks, )) as executor:
+                futures = [(file, executor.submit(parse_file, file, self.encoding, self.chunk_size)) for file in files]
+                self.drain(chunks, futures, read_queue)
+                for file, future in futures:
+                    self.read_result(file, future)
+        finally:
+            self.counters['read'].add(0, 0, time.time() - start)
+            read_queue.put(_done)
+
+    def drain(self, chunks, futures, read_queue):
+        remaining = len(futures)
+        while remaining:
+            try:
+                file, chunk = chunks.get(timeout=1)
+            except Empty:
+                # A reader process that died never sends its end marker.
+                if all(future.done() for _, future in futures) and chunks.empty():
+                    break
+                continue
+
+            if chunk is None:
+                remaining -= 1
+                continue
+            self.counters['read'].add(len(chunk), len(chunk), 0)
+            read_queue.put((file, chunk))
+
+    def read_result(self, file, future):
+        try:
+            file, encoding, rows, errors = future.result()
+        except Exception as err:
+            self.error(str(file), 0, f'read:{str(err)}')
+            return
+
+        for error in errors:
+            self.error(*error)
+        lg.info(f'ingest:read:{file}:{rows} rows ({encoding})')
+
+    def transform_chunks(self, read_queue, write_queue):
+        try:
+            while True:
+                item = read_queue.get()
+                if item is _done:
+                    break
+
+                start = time.time()
+                file, chunk = item
+                rows = []
+                for line, row in chunk:
+                    try:
+                        result = self.transform(row)
+                        if result:
+                            rows.append(result)
+                    except Exception as err:
+                        self.error(file, line, f'transform:{str(err)}')
+
+                self.counters['transform'].add(len(chunk), len(rows), time.time() - start)
+                if rows:
+                    write_queue.put((file, chunk[0][0], rows))
+        finally:
+            for _ in range(self.writers):
+                write_queue.put(_done)
+
+    def write(self, write_queue):
+        db = MariaDB()
+        connected = db.connect(self.database, connection=self.info)
+
+        while True:
+            item = write_queue.get()
+            if item is _done:
+                break
+
+            file, line, rows = item
+            if not connected:
+                self.error(file, line, f'write:No database connection, {len(rows)} rows dropped')
+                continue
+
+            # Errors are recorded against the chunk, the writer keeps going so the queue is always drained.
+            start = time.time()
+            count = skipped = 0
+            try:
+                count = db.insert_rows(self.table, rows, self.batch_size, mode=self.mode, commit=True,
+                                       raise_errors=True) or 0
+                # Duplicates are expected in ignore mode and updated rows count twice in update mode, only a
+                # plain INSERT that wrote fewer rows than sent is an error.
+                if count < len(rows):
+                    if self.mode is None:
+                        self.error(file, line, f'write:{len(rows) - count} of {len(rows)} rows not inserted')
+                    elif self.mode == 'ignore':
+                        skipped = len(rows) - count
+            except Exception as err:
+                self.error(file, line, f'write:{str(err)}')
+            self.counters['write'].add(len(rows), count, time.time() - start, skipped)
+
+        if connected:
+            db.connection_close()
+
+    def run(self, files):
+        start = time.time()
+        read_queue = Queue(self.queue_size)
+        write_queue = Queue(self.queue_size)
+
+        threads = [Thread(target=self.read, args=(files, read_queue), name='ingest-read'),
+                   Thread(target=self.transform_chunks, args=(read_queue, write_queue), name='ingest-transform')]
+        threads += [Thread(target=self.write, args=(write_queue,), name=f'ingest-write-{i}')
+                    for i in range(self.writers)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report = {
+            'table': self.table,
+            'files': len(files),
+            'seconds': round(time.time() - start, 3),
+            'stages': {name: counter.snapshot() for name, counter in self.counters.items()},
+            'errors': sorted(self.errors, key=lambda e: (e[0], e[1], e[2])),
+        }
+        lg.info(f"ingest:{self.table}:{report['stages']}")
+        return report
@@ -1,216 +1,521 @@
-from os import listdir, remove
-from csv import reader
-from bs4 import BeautifulSoup
+from os import listdir
 from pathlib import Path
 from db_maria import MariaDB
-from zipfile import ZipFile
-from urllib.request import urlretrieve, urlopen
+from decode import Decoder, sniff_encoding
 
-import string
-import chardet
+import re
 import logging as lg
 
+# Scraping, zip, CSV and pipeline modules are imported where they are used, so importing main to run a
+# query does not pay for them.
+
 _path = Path(__file__).cwd()
 
+_reject_zone_types = [
+    'parish', 'dependency', 'department', 'federal district', 'autonomous district', 'island council',
+    'autonomous region', 'special administrative region', 'special municipality', 'administration',
+    'metropolitan department', 'council area', 'district council area', 'local council',
+    'administrative atoll', 'zone', 'autonomous city', 'administrative region', 'administrative territory',
+    'oblast', 'economic prefecture', 'department', 'departments', 'free communal consortia', 'town council',
+]
 
-class App:
-    def __init__(self, **kwargs):
-        self.db = None
+_zone_suffix = 'SubdivisionCodes.csv'
 
-    def setup(self, db_name, new=False):
-        def tables():
-            return (
-                # ('address',
-                #  'id SMALLINT(4) UNSIGNED NOT NULL AUTO_INCREMENT, '
-                #  'street VARCHAR(30) NOT NULL, '
-                #  'unit_number VARCHAR(30) NOT NULL, '
-                #  'city VARCHAR(30) NOT NULL, '
-                #  'state VARCHAR(30), '
-                #  'zip_code VARCHAR(30), '
-                #  'country_code KEY (id)'
-                #  'comments VARCHAR(1024), '
-                #  ),
-                ('country',
-                 'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
-                 'name VARCHAR(100) UNIQUE NOT NULL, '
-                 'code2 VARCHAR(2) UNIQUE NOT NULL, '
-                 'code3 VARCHAR(3) UNIQUE NOT NULL, '
-                 'PRIMARY KEY (id)'
-                 ),
-                ('country_zones',
-                 'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
-                 'country_id INT UNSIGNED NOT NULL, '
-                 'code VARCHAR(3) NOT NULL, '
-                 'name VARCHAR(100) NOT NULL, '
-                 'type VARCHAR(60), '
-                 'PRIMARY KEY (id), '
-                 'INDEX (country_id), '
-                 'CONSTRAINT id_code UNIQUE (country_id, code), '
-                 'FOREIGN KEY (country_id) '
-                 'REFERENCES country (id) '
-                 'ON DELETE CASCADE',
-                 ),
-                ('country_places',
-                 'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
-                 'zone_id INT UNSIGNED NOT NULL, '
-                 'code VARCHAR(3) NOT NULL, '
-                 'name VARCHAR(256) NOT NULL, '
-                 'flags VARCHAR(9), '
-                 'coordinates VARCHAR(16), '
-                 'PRIMARY KEY (id), '
-                 'INDEX (zone_id), '
-                 'CONSTRAINT id_code UNIQUE (zone_id, code), '
-                 'FOREIGN KEY (zone_id) '
-                 'REFERENCES country_zones (id) '
-                 'ON DELETE CASCADE',
-                 ),
-            )
+_country_url = 'https://www.iban.com/country-codes'
+_locode_index_url = 'http://www.unece.org/cefact/codesfortrade/codes_index.html'
+_locode_url = 'http://www.unece.org/fileadmin/DAM/cefact/locode/'
 
-        def init_tables():
-            for table in tables():
-                table_name, table_sql = table
-                if not db.table_exist(table_name):
-                    db.create_table(table_name, table_sql)
+# UN/LOCODE coordinates are degrees and minutes, e.g. "4230N 07900W".
+_coordinates = re.compile(r'^(\d{2})(\d{2})([NS])\s+(\d{3})(\d{2})([EW])$')
+_coordinates_sql = "s.coordinates REGEXP '^[0-9]{4}[NS] [0-9]{5}[EW]$'"
+_latitude_sql = f"IF({_coordinates_sql}, (SUBSTR(s.coordinates, 1, 2) + SUBSTR(s.coordinates, 3, 2) / 60) * " \
+                f"IF(SUBSTR(s.coordinates, 5, 1)='S', -1, 1), NULL)"
+_longitude_sql = f"IF({_coordinates_sql}, (SUBSTR(s.coordinates, 7, 3) + SUBSTR(s.coordinates, 10, 2) / 60) * " \
+                 f"IF(SUBSTR(s.coordinates, 12, 1)='W', -1, 1), NULL)"
 
-            if db.execute('SELECT COUNT(*) FROM country'):
-                if not db.fetchone()[0]:
-                    self.update_country()
 
-            if db.execute('SELECT COUNT(*) FROM country_zones'):
-                if not db.fetchone()[0]:
-                    self.update_country_zones()
+def latest_release(file_names):
+    # UN/LOCODE file names start with the release, e.g. "2019-2 UNLOCODE CodeListPart1.csv". Files of older
+    # releases left in the directory are ignored.
+    releases = {}
+    for file_name in file_names:
+        releases.setdefault(file_name.split(' ', 1)[0], []).append(file_name)
+    return tuple(sorted(releases[max(releases)])) if releases else ()
+
+
+def get_place_files():
+    return latest_release([name for name in listdir('.') if 'UNLOCODE' in name and name.endswith('.csv')])
+
+
+def get_zone_file():
+    files = latest_release([name for name in listdir('.') if name.endswith(_zone_suffix)])
+    return files[0] if files else None
+
+
+def source_name(table, file_name):
+    # The sync source must outlive the release, otherwise every release would be synced as a new source.
+    return f'{table}:{Path(file_name).stem.split(" ")[-1]}'
+
+
+def parse_coordinates(value):
+    match = _coordinates.match(value.strip()) if value else None
+    if not match:
+        return None, None
 
-            if db.execute('SELECT COUNT(*) FROM country_places'):
+    lat_deg, lat_min, lat_dir, lon_deg, lon_min, lon_dir = match.groups()
+    latitude = round(int(lat_deg) + int(lat_min) / 60, 5)
+    longitude = round(int(lon_deg) + int(lon_min) / 60, 5)
+    return -latitude if lat_dir == 'S' else latitude, -longitude if lon_dir == 'W' else longitude
+
+
+class App:
+    def __init__(self, **kwargs):
+        self.db = None
+        self.info = None
+        self.local_infile = kwargs.get('local_infile', False)
+        self.readers = kwargs.get('readers', 0)
+        self.writers = kwargs.get('writers', 0)
+        self.commit_every = kwargs.get('commit_every', 20)
+        self.encoding = kwargs.get('encoding')
+        self.replicas = kwargs.get('replicas')
+        self.stream = kwargs.get('stream', False)
+        self.country_url = kwargs.get('country_url', _country_url)
+        self.locode_index_url = kwargs.get('locode_index_url', _locode_index_url)
+        self.locode_url = kwargs.get('locode_url', _locode_url)
+        self.fetcher = None
+
+    @staticmethod
+    def tables():
+        return (
+            # ('address',
+            #  'id SMALLINT(4) UNSIGNED NOT NULL AUTO_INCREMENT, '
+            #  'street VARCHAR(30) NOT NULL, '
+            #  'unit_number VARCHAR(30) NOT NULL, '
+            #  'city VARCHAR(30) NOT NULL, '
+            #  'state VARCHAR(30), '
+            #  'zip_code VARCHAR(30), '
+            #  'country_code KEY (id)'
+            #  'comments VARCHAR(1024), '
+            #  ),
+            ('country',
+             'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
+             'name VARCHAR(100) UNIQUE NOT NULL, '
+             'code2 VARCHAR(2) UNIQUE NOT NULL, '
+             'code3 VARCHAR(3) UNIQUE NOT NULL, '
+             'PRIMARY KEY (id)'
+             ),
+            ('country_zones',
+             'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
+             'country_id INT UNSIGNED NOT NULL, '
+             'code VARCHAR(3) NOT NULL, '
+             'name VARCHAR(100) NOT NULL, '
+             'type VARCHAR(60), '
+             'PRIMARY KEY (id), '
+             'INDEX (country_id), '
+             'CONSTRAINT id_code UNIQUE (country_id, code), '
+             'FOREIGN KEY (country_id) '
+             'REFERENCES country (id) '
+             'ON DELETE CASCADE',
+             ),
+            ('country_places',
+             'id INT UNSIGNED NOT NULL AUTO_INCREMENT, '
+             'zone_id INT UNSIGNED NOT NULL, '
+             'code VARCHAR(3) NOT NULL, '
+             'name VARCHAR(256) NOT NULL, '
+             'flags VARCHAR(9), '
+             'coordinates VARCHAR(16), '
+             'latitude DECIMAL(7,5), '
+             'longitude DECIMAL(8,5), '
+             'PRIMARY KEY (id), '
+             'INDEX (zone_id), '
+             'INDEX (latitude, longitude), '
+             'CONSTRAINT id_code UNIQUE (zone_id, code), '
+             'FOREIGN KEY (zone_id) '
+             'REFERENCES country_zones (id) '
+             'ON DELETE CASCADE',
+             ),
+        )
+
+    def migrate_tables(self):
+        # country_places tables created before latitude/longitude existed get the columns, their index and
+        # the values derived from the coordinates already stored.
+        db = self.db
+        if 'latitude' in db.get_column_names('country_places'):
+            return
+
+        sql = 'ALTER TABLE country_places ' \
+              'ADD COLUMN latitude DECIMAL(7,5) AFTER coordinates, ' \
+              'ADD COLUMN longitude DECIMAL(8,5) AFTER latitude, ' \
+              'ADD INDEX latitude (latitude, longitude);'
+        if db.execute(sql) is None:
+            return
+        db.execute(f'UPDATE country_places s SET latitude={_latitude_sql}, longitude={_longitude_sql};')
+        lg.info('migrate_tables:Added latitude and longitude to country_places')
+        return True
+
+    def setup(self, db_name, new=False, sync=False):
+        def load(table, loader, batch=True):
+            if db.execute(f'SELECT COUNT(*) FROM {table}'):
                 if not db.fetchone()[0]:
-                    self.update_country_places()
+                    if not batch:
+                        # The streaming loader commits through its own connection and must see those commits,
+                        # which an open REPEATABLE READ transaction here would hide.
+                        return loader()
+                    with db.batch(commit_every=self.commit_every):
+                        loader()
+
+        def init_tables():
+            # One snapshot answers every table_exist, it is checked for all tables before the first CREATE
+            # TABLE makes it stale.
+            db.catalog()
+            missing = [(table_name, table_sql) for table_name, table_sql in self.tables()
+                       if not db.table_exist(table_name)]
+            for table_name, table_sql in missing:
+                db.create_table(table_name, table_sql)
+            self.migrate_tables()
+
+            if sync:
+                return self.sync()
+
+            load('country', self.update_country)
+            if self.stream:
+                load('country_zones', self.update_zones_and_places, batch=False)
+            else:
+                load('country_zones', self.update_country_zones)
+                load('country_places', self.update_country_places)
+
+        def bulk_load_tables():
+            # Fresh tables are created with only their primary key. Each table gets its secondary indexes,
+            # UNIQUE constraints and foreign keys in one ALTER once it is loaded, before the next table
+            # joins against it. IGNORE keeps the INSERT IGNORE semantics of the loaders for duplicates.
+            with db.bulk_load(ignore=True) as loader:
+                for table_name, table_sql in self.tables():
+                    loader.create_table(table_name, table_sql)
+
+                load('country', self.update_country)
+                loader.finish('country')
+                if self.stream:
+                    # Zones and places come from one pass over the archive, the zone keys are added as soon as
+                    # the zones are in and before the zone lookup for the places is built.
+                    load('country_zones', lambda: self.update_zones_and_places(lambda: loader.finish('country_zones')),
+                         batch=False)
+                    loader.finish('country_zones')
+                else:
+                    load('country_zones', self.update_country_zones)
+                    loader.finish('country_zones')
+                    load('country_places', self.update_country_places)
+                loader.finish('country_places')
+
+            for result in loader.results.values():
+                if not result['valid']:
+                    print(f"Constraint check failed for {result['table']}: {result}")
+            return loader.results
 
         db = self.db = MariaDB(log_level=lg.DEBUG)
 
-        info = {
+        info = self.info = {
             'host': 'localhost',
             'port': 3306,
             'user': 'mary',
             'password': 'password',
             'database': db_name,
+            'local_infile': self.local_infile,
         }
-        if db.connect(db_name, connection=info):
+        # The loaders read back what they just wrote (lookups), so reads stick to the primary for a while after a write.
+        if db.connect(db_name, connection=info, replicas=self.replicas, read_your_writes=30):
             print(f'Connected to database "{info["database"]}" as user "{info["user"]}" successful.')
             if new:
                 sql = 'DROP TABLE IF EXISTS country_places, country_zones, country;'
                 db.execute(sql)
-            init_tables()
+
+            if new and not sync:
+                # The upserts done by sync() need the UNIQUE keys in place, so it always uses init_tables().
+                bulk_load_tables()
+            else:
+                init_tables()
         else:
             print(f'Could not connected to database "{info["database"]}" as user "{info["user"]}".')
 
-    @staticmethod
-    def get_country_csv_file():
-        with urlopen('https://www.iban.com/country-codes') as f:
-            html = f.read()
-            soup = BeautifulSoup(html, features="html.parser")
-            li = soup.find("table", {"id": "myTable"})
-            table_body = li.find('tbody')
-            rows = table_body.findChildren("tr")
-
-            with open("country.csv", "w") as text_file:
-                for row in rows:
-                    line = ''
-                    for idx, column in enumerate(row.text.split('\n')[:4]):
-                        if ',' in column:
-                            col = column.split(',')
-                            column = f'{col[0].strip(" ")} ({col[1].strip(" ")})'
-                        line += f'{column},'
-                    print(line.strip(','), file=text_file)
+    def get_fetcher(self):
+        from fetch import Fetcher
 
-    @staticmethod
-    def get_country_zone_csv_files():
-        with urlopen('http://www.unece.org/cefact/codesfortrade/codes_index.html') as response:
-            html = response.read()
+        if not self.fetcher:
+            self.fetcher = Fetcher(_path)
+        return self.fetcher
+
+    def get_country_csv_file(self):
+        from bs4 import BeautifulSoup
 
+        html = self.get_fetcher().get(self.country_url, _path.joinpath('country-codes.html'))
+        soup = BeautifulSoup(html, features="html.parser")
+        li = soup.find("table", {"id": "myTable"})
+        table_body = li.find('tbody')
+        rows = table_body.findChildren("tr")
+
+        with open("country.csv", "w") as text_file:
+            for row in rows:
+                line = ''
+                for idx, column in enumerate(row.text.split('\n')[:4]):
+                    if ',' in column:
+                        col = column.split(',')
+                        column = f'{col[0].strip(" ")} ({col[1].strip(" ")})'
+                    line += f'{column},'
+                print(line.strip(','), file=text_file)
+
+    def get_locode_zip_url(self):
+        from bs4 import BeautifulSoup
+
+        html = self.get_fetcher().get(self.locode_index_url, _path.joinpath('codes_index.html'))
         soup = BeautifulSoup(html, features="html.parser")
         parsed_data = soup.find("div", {"id": "c21211"})
         version_number = parsed_data.find_all(['td'])[3].text.split()[-1:][0]
-        unlocode_zip_file = 'loc' + version_number.replace('-', '')[2:] + 'csv.zip'
-
-        file = _path.joinpath(unlocode_zip_file)
-        if not file.exists():
-            url = 'http://www.unece.org/fileadmin/DAM/cefact/locode/' + unlocode_zip_file
-            src_file_name = url.split('/')[-1]
-            urlretrieve(url, src_file_name)
-
-            with ZipFile(src_file_name, 'r') as z:
-                z.extractall('.')
+        return self.locode_url + 'loc' + version_number.replace('-', '')[2:] + 'csv.zip'
+
+    def open_locode_zip(self):
+        from fetch import BlockReader, iter_zip, prefetch
+
+        # The zip is cached next to the CSV files, a conditional request only downloads it again when it changed,
+        # and an interrupted download resumes from the .part file.
+        url = self.get_locode_zip_url()
+        changed, blocks = self.get_fetcher().open(url, _path.joinpath(url.split('/')[-1]))
+        return changed, iter_zip(BlockReader(prefetch(blocks)))
+
+    def get_country_zone_csv_files(self):
+        # The LOAD DATA, sync and pipeline loaders read the CSV files from disk. Members are written out while
+        # the archive is still downloading; update_zones_and_places() loads straight from the stream instead.
+        changed, members = self.open_locode_zip()
+        if not changed and get_zone_file():
+            return
+
+        for member in members:
+            if member.name.endswith('.csv'):
+                with open(_path.joinpath(Path(member.name).name), 'wb') as f:
+                    for chunk in member.chunks():
+                        f.write(chunk)
 
     def update_country(self):
         file = _path.joinpath('country.csv')
         if not file.exists():
             self.get_country_csv_file()
 
-        if file.exists():
-            with open(str(file.resolve())) as f:
-                results = reader(f, delimiter=',', quotechar='"')
+        if file.exists() and self.local_infile:
+            return self.db.load_csv('country', file.resolve(), columns=('name', 'code2', 'code3'), mode='ignore',
+                                    encoding=self.encoding or sniff_encoding(file),
+                                    transforms={'name': 'TRIM(s.name)', 'code2': 'TRIM(s.code2)',
+                                                'code3': 'TRIM(s.code3)'})
 
-                for row in results:
-                    sql = 'SELECT id FROM country WHERE country.code2="%s";'
-                    if self.db.execute(sql, (row[1].strip(' '), )):
-                        continue
+        if file.exists():
+            countries = self.db.build_lookup('country', 'code2', fallback=False)
 
-                    self.db.insert_row('country', (row[0].strip(' '), row[1].strip(' '), row[2].strip(' ')))
+            rows = [row for row in self.country_rows(Decoder(file, self.encoding)) if row[1] not in countries]
+            self.db.insert_rows('country', rows, mode='ignore')
 
     def update_country_zones(self):
-        reject = [
-            'parish', 'dependency', 'department', 'federal district', 'autonomous district', 'island council',
-            'autonomous region', 'special administrative region', 'special municipality', 'administration',
-            'metropolitan department', 'council area', 'district council area', 'local council',
-            'administrative atoll', 'zone', 'autonomous city', 'administrative region', 'administrative territory',
-            'oblast', 'economic prefecture', 'department', 'departments', 'free communal consortia', 'town council',
-        ]
-
-        file = '2019-2 SubdivisionCodes.csv'
-        with open(file, errors='ignore') as f:
-            results = reader(f, delimiter=',', quotechar='"')
-
-            for idx, row in enumerate(results):
-                if row[3].lower() in reject:
-                    continue
-
-                for column, value in enumerate(row):
-                    j = value.replace('?', '').replace('\n', ' ')
-                    row[column] = j
-
-                sql = 'SELECT id FROM country WHERE country.code2=%s;'
-                if self.db.execute(sql, (row[0],)):
-                    _id = self.db.fetchone()[0]
-                    self.db.insert_row('country_zones', (_id, row[1], row[2], row[3]))
+        file = get_zone_file()
+        if not file:
+            lg.error(f'update_country_zones:No *{_zone_suffix} file found')
+            return
+
+        if self.local_infile:
+            def clean(column):
+                return f"REPLACE(REPLACE(s.{column}, '?', ''), '\\n', ' ')"
+
+            return self.db.load_csv(
+                'country_zones', file, columns=('country', 'code', 'name', 'type'), mode='ignore',
+                encoding=self.encoding or sniff_encoding(file),
+                transforms={'country_id': 'c.id', 'code': clean('code'), 'name': clean('name'), 'type': clean('type')},
+                joins='JOIN country c ON c.code2=s.country',
+                where=f"LOWER(s.type) NOT IN ({','.join(repr(i) for i in set(_reject_zone_types))})")
+
+        countries = self.db.build_lookup('country', 'code2')
+        self.db.insert_rows('country_zones', self.zone_rows(Decoder(file, self.encoding), countries), mode='ignore')
 
     def update_country_places(self):
-        def get_files():
-            file_list = []
-            for file_name in listdir('.'):
-                if 'UNLOCODE' in file_name and file_name.endswith('.csv'):
-                    file_list.append(file_name)
-            return tuple(sorted(file_list))
-
-        for file in get_files():
-            with open(file, encoding='iso-8859-1') as f:
-                results = reader(f, delimiter=',', quotechar='"')
-                for i, row in enumerate(results):
-                    zone_code = row[5].strip()
-                    place_code = row[2]
-                    place_name = row[3]
-                    place_flags = row[6]
-                    place_coordinates = row[10]
-                    sql = 'SELECT id FROM country WHERE country.code2=%s;'
-
-                    if self.db.execute(sql, (row[1], )):
-                        country_id = self.db.fetchone()[0]
-                        sql = 'SELECT country_zones.id ' \
-                              'FROM country_zones ' \
-                              'WHERE country_zones.country_id=%s AND country_zones.code=%s;'
-
-                        if self.db.execute(sql, (country_id, zone_code)):
-                            zone_id = self.db.fetchone()[0]
-                            self.db.insert_row('country_places', (
-                                zone_id, place_code, place_name, place_flags, place_coordinates))
+        if self.local_infile:
+            columns = ('status', 'country', 'code', 'name', 'name_ascii', 'subdivision',
+                       'function', 'state', 'date', 'iata', 'coordinates', 'remarks')
+            for file in get_place_files():
+                self.db.load_csv(
+                    'country_places', file, columns=columns, encoding=self.encoding or sniff_encoding(file),
+                    mode='ignore',
+                    transforms={'zone_id': 'z.id', 'code': 's.code', 'name': 's.name',
+                                'flags': 's.function', 'coordinates': 's.coordinates',
+                                'latitude': _latitude_sql, 'longitude': _longitude_sql},
+                    joins='JOIN country c ON c.code2=s.country '
+                          'JOIN country_zones z ON z.country_id=c.id AND z.code=TRIM(s.subdivision)')
+            return
+
+        countries = self.db.build_lookup('country', 'code2')
+        zones = self.db.build_lookup('country_zones', ('country_id', 'code'))
+
+        if self.writers:
+            from ingest import Pipeline
+
+            def transform(row):
+                return self.place_row(row, countries, zones)
+
+            # The lookups fall back to self.db on a miss, which is only safe from the single transform thread.
+            pipeline = Pipeline('country_places', transform, database=self.db.db_name, connection=self.info,
+                                readers=self.readers or 2, writers=self.writers, encoding=self.encoding)
+            report = pipeline.run(get_place_files())
+            for file, line, message in report['errors']:
+                print(f'{file}:{line}: {message}')
+            return report
+
+        for file in get_place_files():
+            rows = self.place_rows(Decoder(file, self.encoding), countries, zones)
+            self.db.insert_rows('country_places', rows, mode='ignore')
+
+    def update_zones_and_places(self, zones_loaded=None):
+        from queue import Queue
+        from threading import Thread
+        from tempfile import TemporaryFile
+
+        queue = Queue(8)
+        batch_size = 5000
+
+        def write():
+            # A second connection, so inserts overlap with download, decompression and parsing on this thread.
+            db = MariaDB()
+            connected = db.connect(self.db.db_name, connection=self.info)
+            if not connected:
+                lg.error('update_zones_and_places:No writer connection, rows are not loaded')
+            while True:
+                item = queue.get()
+                try:
+                    if item is None:
+                        break
+                    if connected:
+                        db.insert_rows(*item, mode='ignore', commit=True)
+                finally:
+                    queue.task_done()
+            if connected:
+                db.connection_close()
+
+        def put_rows(table, rows):
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    queue.put((table, batch))
+                    batch = []
+            if batch:
+                queue.put((table, batch))
+
+        def spooled_blocks(f):
+            f.seek(0)
+            return iter(lambda: f.read(1024 * 1024), b'')
+
+        countries = self.db.build_lookup('country', 'code2')
+        zones = None
+        spooled = []
+
+        writer = Thread(target=write, name='zip-writer')
+        writer.start()
+        try:
+            _, members = self.open_locode_zip()
+            for member in members:
+                name = Path(member.name).name
+                if name.endswith(_zone_suffix):
+                    put_rows('country_zones', self.zone_rows(member.lines(self.encoding), countries))
+                    # The zone lookup needs every zone committed by the writer first.
+                    queue.join()
+                    if zones_loaded:
+                        zones_loaded()
+                    zones = self.db.build_lookup('country_zones', ('country_id', 'code'))
+                    for f in spooled:
+                        lines = Decoder(name, self.encoding, blocks=spooled_blocks(f))
+                        put_rows('country_places', self.place_rows(lines, countries, zones))
+                        f.close()
+                    spooled = []
+
+                elif 'UNLOCODE' in name and name.endswith('.csv'):
+                    if zones is None:
+                        # Places that arrive before the zone file wait in a temporary file.
+                        f = TemporaryFile()
+                        for chunk in member.chunks():
+                            f.write(chunk)
+                        spooled.append(f)
+                    else:
+                        put_rows('country_places', self.place_rows(member.lines(self.encoding), countries, zones))
+            if spooled:
+                lg.warning(f'update_zones_and_places:No *{_zone_suffix} in the archive, '
+                           f'{len(spooled)} place files skipped')
+        finally:
+            queue.put(None)
+            writer.join()
+            for f in spooled:
+                f.close()
+
+    @staticmethod
+    def country_rows(f):
+        from csv import reader
+
+        for row in reader(f, delimiter=',', quotechar='"'):
+            yield row[0].strip(' '), row[1].strip(' '), row[2].strip(' ')
+
+    @staticmethod
+    def zone_rows(f, countries):
+        from csv import reader
+
+        for row in reader(f, delimiter=',', quotechar='"'):
+            if row[3].lower() in _reject_zone_types:
+                continue
+
+            for column, value in enumerate(row):
+                j = value.replace('?', '').replace('\n', ' ')
+                row[column] = j
+
+            _id = countries.get(row[0])
+            if _id:
+                yield _id, row[1], row[2], row[3]
+
+    @staticmethod
+    def place_row(row, countries, zones):
+        country_id = countries.get(row[1])
+        if country_id:
+            zone_id = zones.get((country_id, row[5].strip()))
+            if zone_id:
+                return (zone_id, row[2], row[3], row[6], row[10]) + parse_coordinates(row[10])
+
+    def place_rows(self, f, countries, zones):
+        from csv import reader
+
+        for row in reader(f, delimiter=',', quotechar='"'):
+            place = self.place_row(row, countries, zones)
+            if place:
+                yield place
+
+    def sync(self):
+        from sync import CsvSync
+
+        syncer = CsvSync(self.db)
+        results = []
+
+        file = _path.joinpath('country.csv')
+        if not file.exists():
+            self.get_country_csv_file()
+        results.append(syncer.sync_file('country', ('code2',), str(file), self.country_rows,
+                                        encoding=self.encoding, source=source_name('country', file.name)))
+
+        countries = self.db.build_lookup('country', 'code2')
+        file = get_zone_file()
+        if not file:
+            lg.error(f'sync:No *{_zone_suffix} file found')
+            return results
+        results.append(syncer.sync_file('country_zones', ('country_id', 'code'), file,
+                                        lambda f: self.zone_rows(f, countries), encoding=self.encoding,
+                                        strict=False, source=source_name('country_zones', file)))
+
+        zones = self.db.build_lookup('country_zones', ('country_id', 'code'))
+        for file in get_place_files():
+            results.append(syncer.sync_file('country_places', ('zone_id', 'code'), file,
+                                            lambda f: self.place_rows(f, countries, zones), encoding=self.encoding,
+                                            source=source_name('country_places', file)))
+
+        for result in results:
+            print(result)
+        return results
 
 
 def main():
@@ -225,9 +530,8 @@ def main():
           f'JOIN country_places ' \
           f'ON country_zones.id=country_places.zone_id WHERE country.code2="CA" AND country_zones.code="ON";'
 
-    if app.db.execute(sql):
-        for idx, row in enumerate(app.db.fetchall()):
-            print(idx, row)
+    for idx, row in enumerate(app.db.query(sql) or ()):
+        print(idx, row)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+########################################################################################################################
+#    File: sync.py
+# Purpose: Incremental, resumable CSV -> table synchronisation using per-row content hashes and file checkpoints.
+#  Author: Dan Huckson, https://github.com/unodan
+########################################################################################################################
+import time
+import hashlib
+import logging as lg
+
+from decode import Decoder
+
+version = '0.1'
+
+_separator = '\x1f'
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def row_hash(values):
+    return hashlib.md5(_separator.join('' if v is None else str(v) for v in values).encode()).hexdigest()
+
+
+class CsvSync:
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.batch_size = kwargs.get('batch_size', 1000)
+        self.files_table = kwargs.get('files_table', 'sync_files')
+        self.rows_table = kwargs.get('rows_table', 'sync_rows')
+        self.init_tables()
+
+    def init_tables(self):
+        if not self.db.table_exist(self.files_table):
+            self.db.create_table(
+                self.files_table,
+                'source VARCHAR(255) NOT NULL, '
+                'file_hash CHAR(64) NOT NULL, '
+                'position INT UNSIGNED NOT NULL DEFAULT 0, '
+                'status VARCHAR(10) NOT NULL, '
+                'updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, '
+                'PRIMARY KEY (source)')
+
+        if not self.db.table_exist(self.rows_table):
+            self.db.create_table(
+                self.rows_table,
+                'source VARCHAR(255) NOT NULL, '
+                'row_key VARCHAR(255) NOT NULL, '
+                'row_hash CHAR(32) NOT NULL, '
+                'PRIMARY KEY (source, row_key)')
+
+    def get_checkpoint(self, source):
+        sql = f'SELECT file_hash, position, status FROM {self.files_table} WHERE source=%s;'
+        if self.db.execute(sql, (source,)):
+            return self.db.fetchone()
+
+    def set_checkpoint(self, source, digest, position, status):
+        sql = f'INSERT INTO {self.files_table} (source, file_hash, position, status) VALUES (%s, %s, %s, %s) ' \
+              f'ON DUPLICATE KEY UPDATE file_hash=VALUES(file_hash), position=VALUES(position), status=VALUES(status);'
+        self.run(sql, (source, digest, position, status))
+
+    def run(self, sql, args=None):
+        # MariaDB.execute logs and swallows errors, a checkpoint must never move past a failed statement.
+        result = self.db.execute(sql, args)
+        if result is None:
+            raise RuntimeError(f'Statement failed: {sql[:200]}')
+        return result
+
+    def apply(self, table, source, upserts, hashes, deletes, key_columns):
+        if upserts:
+            self.db.insert_rows(table, upserts, self.batch_size, mode='update', raise_errors=True)
+            sql = f'INSERT INTO {self.rows_table} (source, row_key, row_hash) VALUES ' \
+                  f"{','.join(['(%s, %s, %s)'] * len(hashes))} ON DUPLICATE KEY UPDATE row_hash=VALUES(row_hash);"
+            self.run(sql, [value for item in hashes for value in (source, ) + item])
+
+        if deletes:
+            condition = ' AND '.join(f'{name}=%s' for name in key_columns)
+            sql = f"DELETE FROM {table} WHERE {' OR '.join([f'({condition})'] * len(deletes))};"
+            self.run(sql, [value for key in deletes for value in key.split(_separator)])
+
+            sql = f"DELETE FROM {self.rows_table} WHERE source=%s AND row_key IN ({','.join(['%s'] * len(deletes))});"
+            self.run(sql, [source] + list(deletes))
+
+    def sync_file(self, table, key_columns, path, rows, **kwargs):
+        encoding = kwargs.get('encoding')
+        strict = kwargs.get('strict', True)
+        source = kwargs.get('source', f'{table}:{path}')
+
+        start = time.time()
+        result = {'source': source, 'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'skipped': False}
+
+        digest = file_hash(path)
+        checkpoint = self.get_checkpoint(source)
+        position = 0
+        if checkpoint and checkpoint[0] == digest:
+            if checkpoint[2] == 'done':
+                result['skipped'] = True
+                lg.info(f'sync:{source}:Unchanged since last sync')
+                return result
+            position = checkpoint[1]
+            lg.info(f'sync:{source}:Resuming from row {position}')
+
+        column_names = self.db.get_column_names(table)[1:]
+        key_index = [column_names.index(name) for name in key_columns]
+
+        existing = {}
+        sql = f'SELECT row_key, row_hash FROM {self.rows_table} WHERE source=%s;'
+        for row_key, digest_ in self.db.iter_query(sql, (source,)):
+            existing[row_key] = digest_
+
+        self.db.set_autocommit(autocommit=False)
+        try:
+            self.set_checkpoint(source, digest, position, 'running')
+            self.db.commit()
+
+            seen = set()
+            upserts = []
+            hashes = []
+            index = 0
+            # A strict decode raises with the byte offset, before a checkpoint can move past bad input.
+            f = Decoder(path, encoding, strict=strict)
+            for index, values in enumerate(rows(f), 1):
+                key = _separator.join(str(values[i]) for i in key_index)
+                seen.add(key)
+                if index <= position:
+                    continue
+
+                digest_ = row_hash(values)
+                previous = existing.get(key)
+                if previous == digest_:
+                    result['unchanged'] += 1
+                    continue
+
+                result['updated' if previous else 'inserted'] += 1
+                upserts.append(tuple(values))
+                hashes.append((key, digest_))
+
+                if len(upserts) >= self.batch_size:
+                    self.apply(table, source, upserts, hashes, None, key_columns)
+                    self.set_checkpoint(source, digest, index, 'running')
+                    self.db.commit()
+                    upserts = []
+                    hashes = []
+
+            self.apply(table, source, upserts, hashes, None, key_columns)
+            self.set_checkpoint(source, digest, index, 'running')
+            self.db.commit()
+
+            deletes = [key for key in existing if key not in seen]
+            for i in range(0, len(deletes), self.batch_size):
+                self.apply(table, source, None, None, deletes[i:i + self.batch_size], key_columns)
+                self.db.commit()
+            result['deleted'] = len(deletes)
+
+            self.set_checkpoint(source, digest, index, 'done')
+            self.db.commit()
+        except Exception as err:
+            self.db.conn.rollback()
+            lg.error(f'sync:{source}:{str(err)}')
+            raise
+        finally:
+            self.db.set_autocommit(autocommit=True)
+
+        result['seconds'] = round(time.time() - start, 3)
+        lg.info(f'sync:{source}:{result}')
+        return result
@@ -0,0 +1,46 @@
+import pytest
+
+from db_maria import ColumnBuffer, Categorical
+
+np = pytest.importorskip('numpy')
+
+
+def test_grow_does_not_mask_new_values():
+    column = ColumnBuffer(np, 'int64', 4, 1024)
+    column.extend((1, None, 3, 4), 0)
+    column.extend((5, 6, 7, 8), 4)
+
+    result = column.finish(8)
+    assert isinstance(result, np.ma.MaskedArray)
+    assert result.mask.tolist() == [False, True, False, False, False, False, False, False]
+    assert result.compressed().tolist() == [1, 3, 4, 5, 6, 7, 8]
+
+
+def test_grow_keeps_values_and_mask():
+    column = ColumnBuffer(np, 'float64', 2, 1024)
+    column.extend((None, 1.5), 0)
+    column.extend((2.5, 3.5, None), 2)
+
+    result = column.finish(5)
+    assert result.mask.tolist() == [True, False, False, False, True]
+    assert result.compressed().tolist() == [1.5, 2.5, 3.5]
+
+
+def test_no_nulls_gives_plain_array():
+    column = ColumnBuffer(np, 'int32', 2, 1024)
+    column.extend((1, 2, 3), 0)
+
+    result = column.finish(3)
+    assert not isinstance(result, np.ma.MaskedArray)
+    assert result.tolist() == [1, 2, 3]
+
+
+def test_categories_fall_back_to_objects():
+    column = ColumnBuffer(np, None, 2, 2)
+    column.extend(('a', None), 0)
+    assert isinstance(column.finish(2), Categorical)
+
+    column.extend(('b', 'c'), 2)
+    result = column.finish(4)
+    assert result.mask.tolist() == [False, True, False, False]
+    assert result.compressed().tolist() == ['a', 'b', 'c']
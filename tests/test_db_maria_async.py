@@ -0,0 +1,128 @@
+import asyncio
+
+from db_maria_async import AsyncMariaDB
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    async def execute(self, sql, args=None):
+        self.conn.executed.append((sql, args))
+        self.rows = self.conn.rows
+        return len(self.rows) or 1
+
+    def mogrify(self, sql, args=None):
+        return sql % tuple(repr(arg) for arg in args)
+
+    async def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    async def fetchall(self):
+        return tuple(self.rows)
+
+    async def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.db = None
+        self.selects = []
+        self.executed = []
+        self.rows = []
+
+    async def select_db(self, database):
+        self.selects.append(database)
+
+    async def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    def __init__(self, size=1):
+        self.free = [FakeConnection() for _ in range(size)]
+        self.connections = list(self.free)
+
+    async def acquire(self):
+        return self.free.pop(0)
+
+    def release(self, conn):
+        self.free.append(conn)
+
+
+def make_db(size=1):
+    db = AsyncMariaDB()
+    db.pool = FakePool(size)
+    db.db_name = 'test'
+    db.max_allowed_packet = 1024 * 1024
+    return db
+
+
+def test_database_selected_once_per_connection():
+    db = make_db()
+
+    async def run():
+        for _ in range(3):
+            await db.execute('SELECT 1')
+
+    asyncio.run(run())
+    conn = db.pool.connections[0]
+    assert conn.selects == ['test']
+    assert len(conn.executed) == 3
+
+
+def test_each_connection_tracks_its_own_database():
+    db = make_db(2)
+
+    async def run():
+        async with db.session() as first, db.session() as second:
+            await first.execute('SELECT 1')
+            await second.execute('SELECT 1')
+
+    asyncio.run(run())
+    assert [conn.selects for conn in db.pool.connections] == [['test'], ['test']]
+
+
+def test_switching_database_reselects():
+    db = make_db()
+
+    async def run():
+        for database in ('test', 'other', 'other', None):
+            async with db.session(database) as session:
+                await session.execute('SELECT 1')
+
+    asyncio.run(run())
+    assert db.pool.connections[0].selects == ['test', 'other', 'test']
+
+
+def test_insert_rows_batches_on_one_connection():
+    db = make_db()
+    db.schema[('test', 'items')] = ('id', 'name', 'size')
+
+    async def run():
+        return await db.insert_rows('items', [('a', 1), ('b', 2), ('c', 3)], batch_size=2, mode='update')
+
+    assert asyncio.run(run()) == 2
+    executed = db.pool.connections[0].executed
+    assert len(executed) == 2
+    sql, args = executed[0]
+    assert sql.startswith("INSERT INTO items (name,size) VALUES ('a',1),('b',2)")
+    assert 'ON DUPLICATE KEY UPDATE name=VALUES(name),size=VALUES(size)' in sql
+    assert args is None
+    assert executed[1][0].startswith("INSERT INTO items (name,size) VALUES ('c',3)")
+
+
+def test_insert_rows_splits_batches_at_max_allowed_packet():
+    db = make_db()
+    db.schema[('test', 'items')] = ('id', 'name')
+    rows = [('x' * 400,) for _ in range(10)]
+    db.max_allowed_packet = 1024 + len('INSERT INTO items (name) VALUES ;') + 1000
+
+    async def run():
+        return await db.insert_rows('items', rows, batch_size=100)
+
+    asyncio.run(run())
+    executed = db.pool.connections[0].executed
+    assert [sql.count('x' * 400) for sql, _ in executed] == [2, 2, 2, 2, 2]
@@ -0,0 +1,219 @@
+import io
+import json
+import zipfile
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from fetch import Fetcher, BlockReader, iter_zip, prefetch
+
+_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        files = self.server.files
+        data = files.get(self.path)
+        if data is None:
+            return self.respond(404)
+
+        etag = f'"{len(data)}-{hash(data) & 0xffff}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, etag=etag)
+
+        ranged = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if ranged and (if_range is None or if_range in (etag, _modified)):
+            start = int(ranged.split('=')[1].rstrip('-'))
+            if start >= len(data):
+                return self.respond(416, etag=etag)
+            return self.respond(206, data[start:], etag=etag,
+                                content_range=f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.respond(200, data, etag=etag)
+
+    def respond(self, code, body=b'', etag=None, content_range=None):
+        self.server.log.append((self.path, code, self.headers.get('Range')))
+        self.send_response(code)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', _modified)
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY', 'all_proxy', 'ALL_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files = {}
+    httpd.log = []
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class Unseekable:
+    # zipfile writes data descriptors when it cannot seek back to patch the local headers.
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+def make_zip(members, seekable=True):
+    target = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(target, 'w') as archive:
+        for name, data, method in members:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = method
+            if seekable:
+                archive.writestr(info, data)
+            else:
+                with archive.open(info, 'w') as f:
+                    f.write(data)
+    return target.getvalue() if seekable else target.buffer.getvalue()
+
+
+def read_members(data, block_size=7):
+    blocks = (data[i:i + block_size] for i in range(0, len(data), block_size))
+    return [(member.name, b''.join(member.chunks())) for member in iter_zip(BlockReader(blocks))]
+
+
+def test_get_uses_conditional_requests(server, tmp_path):
+    server.files['/a.csv'] = b'a,b\n1,2\n'
+    fetcher = Fetcher(tmp_path)
+    path = tmp_path.joinpath('a.csv')
+
+    assert fetcher.get(f'{server.url}/a.csv', path) == b'a,b\n1,2\n'
+    assert fetcher.get(f'{server.url}/a.csv', path) == b'a,b\n1,2\n'
+    assert [code for _, code, _ in server.log] == [200, 304]
+
+    server.files['/a.csv'] = b'a,b\n3,4\n'
+    assert fetcher.get(f'{server.url}/a.csv', path) == b'a,b\n3,4\n'
+    assert path.read_bytes() == b'a,b\n3,4\n'
+
+
+def test_open_not_modified_reads_cached_file(server, tmp_path):
+    server.files['/b.bin'] = bytes(range(256)) * 100
+    fetcher = Fetcher(tmp_path, block_size=1000)
+    path = tmp_path.joinpath('b.bin')
+
+    changed, blocks = fetcher.open(f'{server.url}/b.bin', path)
+    assert changed and b''.join(blocks) == server.files['/b.bin']
+    assert path.exists() and not tmp_path.joinpath('b.bin.part').exists()
+
+    changed, blocks = fetcher.open(f'{server.url}/b.bin', path)
+    assert not changed and b''.join(blocks) == server.files['/b.bin']
+    assert server.log[-1][1] == 304
+
+
+def test_open_resumes_partial_download(server, tmp_path):
+    data = bytes(range(256)) * 100
+    server.files['/c.bin'] = data
+    fetcher = Fetcher(tmp_path, block_size=1000)
+    path = tmp_path.joinpath('c.bin')
+
+    changed, blocks = fetcher.open(f'{server.url}/c.bin', path)
+    next(blocks)
+    blocks.close()
+    part = tmp_path.joinpath('c.bin.part')
+    assert 0 < part.stat().st_size < len(data)
+
+    changed, blocks = fetcher.open(f'{server.url}/c.bin', path)
+    assert b''.join(blocks) == data
+    assert server.log[-1][1] == 206 and server.log[-1][2] == 'bytes=1000-'
+    assert path.read_bytes() == data
+
+
+def test_open_restarts_when_file_changed(server, tmp_path):
+    fetcher = Fetcher(tmp_path)
+    path = tmp_path.joinpath('d.bin')
+    part = tmp_path.joinpath('d.bin.part')
+    part.write_bytes(b'stale')
+    with open(fetcher.meta_path(part), 'w') as f:
+        json.dump({'etag': '"old"'}, f)
+
+    server.files['/d.bin'] = b'new contents'
+    changed, blocks = fetcher.open(f'{server.url}/d.bin', path)
+    assert changed and b''.join(blocks) == b'new contents'
+    assert server.log[-1][1] == 200
+    assert path.read_bytes() == b'new contents'
+
+
+def test_iter_zip_reads_stored_and_deflated_members():
+    members = [('a.csv', b'x,y\n' * 50, zipfile.ZIP_STORED), ('b.csv', b'1,2\n' * 500, zipfile.ZIP_DEFLATED),
+               ('empty.csv', b'', zipfile.ZIP_STORED)]
+    assert read_members(make_zip(members)) == [(name, data) for name, data, _ in members]
+
+
+def test_iter_zip_reads_data_descriptors():
+    members = [('a.csv', b'x,y\n' * 50, zipfile.ZIP_DEFLATED), ('b.csv', b'1,2\n' * 500, zipfile.ZIP_DEFLATED)]
+    data = make_zip(members, seekable=False)
+    assert b'PK\x07\x08' in data
+    assert read_members(data) == [(name, data) for name, data, _ in members]
+
+
+def test_iter_zip_skips_unread_members():
+    members = [('a.csv', b'a' * 1000, zipfile.ZIP_DEFLATED), ('b.csv', b'b' * 10, zipfile.ZIP_STORED)]
+    blocks = iter([make_zip(members)])
+    names = [member.name for member in iter_zip(BlockReader(blocks))]
+    assert names == ['a.csv', 'b.csv']
+
+
+def test_iter_zip_detects_crc_mismatch():
+    data = bytearray(make_zip([('a.csv', b'hello world', zipfile.ZIP_STORED)]))
+    data[data.index(b'hello')] = ord('j')
+    with pytest.raises(ValueError, match='CRC'):
+        read_members(bytes(data))
+
+
+def test_open_streams_zip_lines(server, tmp_path):
+    server.files['/places.zip'] = make_zip([('places.csv', 'a,Zürich\nb,Köln\n'.encode(), zipfile.ZIP_DEFLATED)])
+
+    changed, blocks = Fetcher(tmp_path).open(f'{server.url}/places.zip', tmp_path.joinpath('places.zip'))
+    members = iter_zip(BlockReader(prefetch(blocks)))
+    lines = [(member.name, list(member.lines())) for member in members]
+    assert changed
+    assert lines == [('places.csv', ['a,Zürich\n', 'b,Köln\n'])]
+
+
+def test_prefetch_closes_source_when_consumer_stops():
+    closed = threading.Event()
+
+    def source():
+        try:
+            for i in range(1000):
+                yield bytes([i % 256])
+        finally:
+            closed.set()
+
+    blocks = prefetch(source(), queue_size=2)
+    assert next(blocks) == b'\x00'
+    blocks.close()
+    assert closed.wait(5)
+
+
+def test_prefetch_reraises_producer_errors():
+    def source():
+        yield b'a'
+        raise OSError('connection reset')
+
+    with pytest.raises(OSError, match='connection reset'):
+        list(prefetch(source()))
@@ -0,0 +1,7 @@
+from bench import measure_startup, _startup_budget
+
+
+def test_startup_within_budget():
+    median, loaded = measure_startup(5)
+    assert not loaded, f'imported eagerly: {sorted(loaded)}'
+    assert median <= _startup_budget, f'{median:.2f} ms exceeds the {_startup_budget} ms budget'